@@ -0,0 +1,96 @@
+###########################################################
+# association.py
+# Sweep-line versions of the event association tests in
+# helper.py (is_associated and plm_arousal_associated).
+# These work on whole EventTables at once instead of being
+# called for every pair of events.
+###########################################################
+
+import numpy as np
+
+
+def to_microseconds(seconds):
+    # integer microseconds make the strict < and > tests of the constraints exact
+    return np.rint(np.asarray(seconds, dtype=np.float64) * 1e6).astype(np.int64)
+
+def expand_ranges(lo, hi):
+    """Expand the half open ranges [lo[i], hi[i]) into a pair of flat arrays (i, j) listing every j of every range.
+    Empty ranges are skipped, the output is ordered by i then j."""
+    n = np.maximum(hi - lo, 0)
+    total = int(n.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    i = np.repeat(np.arange(lo.size), n)
+    offsets = np.cumsum(n) - n      # where each range starts in the flat output
+    j = np.arange(total) - np.repeat(offsets, n) + np.repeat(lo, n)
+    return i, j
+
+def associated_pairs(events1, events2, constraint=(None, 0.5), fixedOrder=False):
+    """Find every pair of events that helper.is_associated would call associated.
+    Returns two index arrays (i, j) such that is_associated(events1[i], events2[j], constraint, fixedOrder) is True
+    for exactly the listed pairs.  The pairs are ordered by i and then j, the same order a nested loop over events1
+    and then events2 would find them.
+
+    Both EventTables are sorted by start time, so for each event of events1 the candidates that start after it are a
+    contiguous run of events2 found by binary search.  Candidates that start before it (only possible when fixedOrder
+    is False) are bounded by the running maximum of the end times in the same way as EventTable queries.
+    Args:
+        events1: EventTable, the first argument given to is_associated
+        events2: EventTable, the second argument given to is_associated
+        constraint: tuple of seconds (lower, upper) on the gap between the end of the first event and the start of
+            the later one, either may be None.  See helper.is_associated
+        fixedOrder: if True events1[i] must start no later than events2[j]
+    """
+    s1 = to_microseconds(events1.starts)
+    e1 = to_microseconds(events1.ends)
+    s2 = to_microseconds(events2.starts)
+    e2 = to_microseconds(events2.ends)
+    c_lo = None if constraint[0] is None else int(round(constraint[0] * 1e6))
+    c_hi = None if constraint[1] is None else int(round(constraint[1] * 1e6))
+
+    # events2[j] is the later event: c_lo < s2[j] - e1[i] < c_hi and s2[j] >= s1[i] (> if the order is not fixed)
+    lo = np.searchsorted(s2, s1, side='left' if fixedOrder else 'right')
+    if c_lo is not None:
+        lo = np.maximum(lo, np.searchsorted(s2, e1 + c_lo, side='right'))
+    if c_hi is not None:
+        hi = np.searchsorted(s2, e1 + c_hi, side='left')
+    else:
+        hi = np.full(s1.size, s2.size, dtype=lo.dtype)
+    i, j = expand_ranges(lo, hi)
+
+    if not fixedOrder:
+        # events1[i] is the later event: s2[j] <= s1[i] and c_lo < s1[i] - e2[j] < c_hi
+        hi = np.searchsorted(s2, s1, side='right')
+        if c_hi is not None:
+            lo = np.searchsorted(np.maximum.accumulate(e2) if e2.size else e2, s1 - c_hi, side='right')
+        else:
+            lo = np.zeros(s1.size, dtype=hi.dtype)
+        bi, bj = expand_ranges(lo, hi)
+        gap = s1[bi] - e2[bj]
+        keep = np.ones(bi.size, dtype=bool)
+        if c_lo is not None:
+            keep &= gap > c_lo
+        if c_hi is not None:
+            keep &= gap < c_hi
+
+        i = np.concatenate((i, bi[keep]))
+        j = np.concatenate((j, bj[keep]))
+        order = np.lexsort((j, i))
+        i = i[order]
+        j = j[order]
+
+    return i, j
+
+def plm_arousal_mask(plms, arousals, constraint=(0, 0.5)):
+    """Flag the arousals that helper.plm_arousal_associated would associate with at least one PLM.
+    An arousal widened by the constraint is associated if the start or the end of any PLM falls within it.
+    Returns a boolean array aligned with arousals."""
+    ts = to_microseconds(arousals.starts) - int(round(abs(constraint[0]) * 1e6))
+    te = to_microseconds(arousals.ends) + int(round(abs(constraint[1]) * 1e6))
+
+    plm_starts = to_microseconds(plms.starts)
+    plm_ends = np.sort(to_microseconds(plms.ends))
+
+    n = np.searchsorted(plm_starts, te, side='right') - np.searchsorted(plm_starts, ts, side='left')
+    n += np.searchsorted(plm_ends, te, side='right') - np.searchsorted(plm_ends, ts, side='left')
+    return n > 0
@@ -0,0 +1,272 @@
+###########################################################
+# benchmark.py
+# Time the pipeline on a synthetic cohort.  A set of NSRR
+# style .edf.XML annotation files and EDFs (SaO2 and ECG) is
+# generated with MrOS-like night lengths and event rates,
+# then run through the same code as induction.py with a
+# timer on each stage
+#
+# usage: python benchmark.py [--patients N] [--seed S] ...
+###########################################################
+
+import argparse
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+# peak RSS is only available on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import patient
+import pipeline
+import writer
+from patient import Patient, input_files
+from pipeline import Config, Task, patient_seeds, run
+from writer import open_writer
+
+# event rates per hour of sleep, roughly those of the MrOS cohort
+PLM_PER_HOUR = 40
+BILATERAL_FRACTION = 0.3    # fraction of PLMs with a movement of the other leg close by
+AROUSAL_PER_HOUR = 25
+RESP_PER_HOUR = 15
+DESAT_PER_HOUR = 12
+NSVT_PER_NIGHT = 6
+
+RESP_NAMES = ['Obstructive Apnea', 'Central Apnea', 'Mixed Apnea', 'Hypopnea', 'Obstructive Hypopnea',
+              'Central Hypopnea']
+
+SAO2_RATE = 1       # Hz
+ECG_RATE = 256      # Hz
+
+# the stages that are timed: (name, object, attribute).  The time of a stage includes any stage called from it
+STAGES = [('read_annotations', patient, 'read_annotations'),
+          ('set_sleep_stages', Patient, 'set_sleep_stages'),
+          ('get_plm', Patient, 'get_plm'),
+          ('get_arousals', Patient, 'get_arousals'),
+          ('get_respiratory_events', Patient, 'get_respiratory_events'),
+          ('find_plm_associations', Patient, 'find_plm_associations'),
+          ('find_arousal_association', Patient, 'find_arousal_association'),
+          ('find_arousal_plm_assoc', Patient, 'find_arousal_plm_assoc'),
+          ('extract_O2_sat', Patient, 'extract_O2_sat'),
+          ('get_control_periods_batch', Patient, 'get_control_periods_batch'),
+          ('compute_period_features', pipeline, 'compute_period_features'),
+          ('patient_strata', pipeline, 'patient_strata'),
+          ('write_rows', writer.ResultsWriter, 'write_rows'),
+          ('flush', writer.ResultsWriter, 'flush')]
+
+
+def write_edf(path, start_time, n_records, signals):
+    """Write a minimal EDF file with records of 1 second.
+
+    :param signals: list of tuples (label, sample rate, physical min, physical max, samples)
+    """
+    n = len(signals)
+
+    def fields(values, width):
+        return ''.join(str(v).ljust(width)[:width] for v in values)
+
+    header = ('0'.ljust(8) + 'X X X X'.ljust(80) + 'Startdate X X X X'.ljust(80) +
+              start_time.strftime('%d.%m.%y') + start_time.strftime('%H.%M.%S') +
+              str(256 * (n + 1)).ljust(8) + ''.ljust(44) + str(n_records).ljust(8) + '1'.ljust(8) + str(n).ljust(4))
+    header += fields([s[0] for s in signals], 16)
+    header += fields(['' for s in signals], 80)
+    header += fields(['' for s in signals], 8)
+    header += fields([s[2] for s in signals], 8)
+    header += fields([s[3] for s in signals], 8)
+    header += fields([-32768 for s in signals], 8)
+    header += fields([32767 for s in signals], 8)
+    header += fields(['' for s in signals], 80)
+    header += fields([s[1] for s in signals], 8)
+    header += fields(['' for s in signals], 32)
+
+    records = []
+    for label, rate, pmin, pmax, samples in signals:
+        digital = np.round((np.asarray(samples) - pmin) / float(pmax - pmin) * 65535 - 32768)
+        records.append(np.clip(digital, -32768, 32767).astype('<i2').reshape(n_records, rate))
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(np.concatenate(records, axis=1).tobytes())
+
+def make_night(rng, hours):
+    """A hypnogram of about hours of recording: wake at either end and runs of sleep stages with brief wakes.
+    Returns the list of stages, one per 30 second epoch"""
+    n_epochs = int(hours * 120)
+    stages = []
+    stage = 0
+    for epoch in range(n_epochs):
+        if epoch < 30 or epoch >= n_epochs - 20:
+            stage = 0
+        elif stage == 0 or rng.random() < 0.05:
+            stage = rng.choice([0, 1, 2, 2, 2, 3, 5, 5])
+        stages.append(stage)
+    return stages
+
+def poisson_times(rng, rate_per_hour, t0, t1):
+    # start times (seconds) of a Poisson process over [t0, t1)
+    times = []
+    t = t0
+    while True:
+        t += rng.expovariate(rate_per_hour / 3600.0)
+        if t >= t1:
+            return times
+        times.append(round(t, 1))
+
+def make_events(rng, duration):
+    """List of scored events (start, duration, name) over a night of duration seconds"""
+    events = []
+    for t in poisson_times(rng, PLM_PER_HOUR, 600, duration - 60):
+        side = rng.choice(['Left', 'Right'])
+        events.append((t, round(rng.uniform(0.5, 5.0), 1), 'PLM (%s)' % side))
+        if rng.random() < BILATERAL_FRACTION:
+            other = 'Right' if side == 'Left' else 'Left'
+            events.append((round(t + rng.choice([0.0, 0.2, 0.4, 0.6, 1.0, 1.5]), 1), round(rng.uniform(0.5, 5.0), 1),
+                           'PLM (%s)' % other))
+    for t in poisson_times(rng, AROUSAL_PER_HOUR, 600, duration - 60):
+        events.append((t, round(rng.uniform(3.0, 15.0), 1), 'Arousal (ASDA)'))
+    for t in poisson_times(rng, RESP_PER_HOUR, 600, duration - 60):
+        events.append((t, round(rng.uniform(10.0, 40.0), 1), rng.choice(RESP_NAMES)))
+    for t in poisson_times(rng, DESAT_PER_HOUR, 600, duration - 60):
+        events.append((t, round(rng.uniform(10.0, 30.0), 1), 'SpO2 desaturation'))
+    events.sort()
+    return events
+
+def write_xml(path, events, stages):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<CMPStudyConfig>', '<EpochLength>30</EpochLength>',
+             '<ScoredEvents>']
+    for start, duration, name in events:
+        lines.append('<ScoredEvent><Name>%s</Name><Start>%s</Start><Duration>%s</Duration></ScoredEvent>'
+                     % (name, start, duration))
+    lines.append('</ScoredEvents>')
+    lines.append('<SleepStages>')
+    lines.extend('<SleepStage>%d</SleepStage>' % s for s in stages)
+    lines.append('</SleepStages>')
+    lines.append('</CMPStudyConfig>')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def make_signals(seed, duration, ecg):
+    """SaO2 (a slow random walk with a dropout) and optionally an ECG with beats about a second apart"""
+    rs = np.random.RandomState(seed)
+    sao2 = np.clip(95 + np.cumsum(rs.randn(duration * SAO2_RATE)) * 0.05, 80, 99)
+    dropout = rs.randint(0, sao2.size - 60)
+    sao2[dropout:dropout + 30] = 0.0
+    signals = [('SaO2', SAO2_RATE, 0, 100, sao2)]
+
+    if ecg:
+        samples = 0.05 * rs.randn(duration * ECG_RATE)
+        beats = np.cumsum(0.9 + 0.1 * rs.randn(int(duration / 0.8)))
+        beats = (beats[beats < duration - 1] * ECG_RATE).astype(np.intp)
+        for offset, amplitude in enumerate([0.2, 0.7, 1.0, 0.6, 0.1]):
+            samples[beats + offset] += amplitude
+        signals.append(('ECG', ECG_RATE, -2, 2, samples))
+    return signals
+
+def generate_cohort(directory, n_patients, hours=8.0, seed=0, ecg=True):
+    """Write the files of a synthetic cohort to directory and describe the work as for induction.make_tasks
+
+    :return: list of (pt_id, study_times, start_time, nsvt_times, n_events)
+    """
+    rng = random.Random(seed)
+    cohort = []
+    for p in range(n_patients):
+        pt_id = 'BM%04d' % p
+        start_time = datetime.datetime(2000, 1, 1, 21) + datetime.timedelta(seconds=rng.randint(0, 7200))
+        stages = make_night(rng, rng.uniform(0.85, 1.15) * hours)
+        duration = len(stages) * 30
+        events = make_events(rng, duration)
+
+        xml_file, edf_file = input_files(pt_id, directory)
+        write_xml(xml_file, events, stages)
+        write_edf(edf_file, start_time, duration, make_signals(seed + p, duration, ecg))
+
+        # lights off when the recording starts, sleep onset 15 minutes later, lights on 10 minutes before the end
+        study_times = {'sleep_onset': start_time + datetime.timedelta(minutes=15),
+                       'lights_on': start_time + datetime.timedelta(seconds=duration - 600)}
+        nsvt = sorted(rng.sample(range(1800, duration - 1800, 300), NSVT_PER_NIGHT))
+        nsvt_times = [start_time + datetime.timedelta(seconds=s) for s in nsvt]
+        cohort.append((pt_id, study_times, start_time, nsvt_times, len(events)))
+    return cohort
+
+def timed(stage, func, timings):
+    def wrapper(*args, **kwargs):
+        t0 = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            total, calls = timings.get(stage, (0.0, 0))
+            timings[stage] = (total + time.time() - t0, calls + 1)
+    return wrapper
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, None where it is not available"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    return rss / (1024.0 * 1024.0) if os.uname()[0] == 'Darwin' else rss / 1024.0
+
+def benchmark(directory, cohort, config, output_file, seed=123456):
+    """Run the cohort in this process with a timer on each of STAGES.
+    Returns (timings, elapsed) where timings is a dictionary stage -> (seconds, calls)"""
+    timings = {}
+    originals = [(owner, attr, owner.__dict__[attr]) for name, owner, attr in STAGES]
+    for (name, owner, attr), (o, a, func) in zip(STAGES, originals):
+        setattr(owner, attr, timed(name, func, timings))
+
+    tasks = [Task(pt_id, study_times, start_time, nsvt_times, directory, s, (config,), None)
+             for (pt_id, study_times, start_time, nsvt_times, n_events), s
+             in zip(cohort, patient_seeds([c[0] for c in cohort], seed))]
+    try:
+        t0 = time.time()
+        with open_writer(output_file) as w:
+            run(tasks, [w], n_workers=1)
+        elapsed = time.time() - t0
+    finally:
+        for owner, attr, func in originals:
+            setattr(owner, attr, func)
+    return timings, elapsed
+
+def report(timings, elapsed, n_patients, n_events):
+    print
+    print "%-28s %10s %8s %10s" % ('stage', 'seconds', 'calls', '% of run')
+    for name, owner, attr in STAGES:
+        seconds, calls = timings.get(name, (0.0, 0))
+        print "%-28s %10.3f %8d %9.1f%%" % (name, seconds, calls, 100.0 * seconds / elapsed)
+    print
+    print "total %.3f s, %.2f patients/s, %.0f events/s" % (elapsed, n_patients / elapsed, n_events / elapsed)
+    rss = peak_rss_mb()
+    print "peak RSS %s" % ('n/a' if rss is None else '%.1f MB' % rss)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the pipeline on a synthetic MrOS-like cohort')
+    parser.add_argument('--patients', type=int, default=20, help='number of patients to generate')
+    parser.add_argument('--hours', type=float, default=8.0, help='average length of a night')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the data generator')
+    parser.add_argument('--no-ecg', action='store_true', help='only write the SaO2 channel to the EDFs')
+    parser.add_argument('--output', default='.csv', help='extension of the results file: .csv, .parquet, .feather')
+    parser.add_argument('--keep', metavar='DIR', help='generate the cohort in DIR and keep it (otherwise a '
+                                                      'temporary directory is used and removed)')
+    args = parser.parse_args()
+
+    directory = args.keep or tempfile.mkdtemp(prefix='benchmark')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    try:
+        t0 = time.time()
+        cohort = generate_cohort(directory, args.patients, args.hours, args.seed, not args.no_ecg)
+        print "generated %d patients in %.1f s" % (len(cohort), time.time() - t0)
+
+        config = Config(2.5*60, 5*60, 30, 0, 3, 1)
+        timings, elapsed = benchmark(directory, cohort, config, os.path.join(directory, 'results' + args.output))
+        report(timings, elapsed, len(cohort), sum(c[4] for c in cohort))
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory)
@@ -0,0 +1,154 @@
+###########################################################
+# cache.py
+# Define class PatientCache, an on-disk cache of the arrays
+# a Patient derives from its XML and EDF files, so that
+# re-running the pipeline does not parse them again
+###########################################################
+
+import errno
+import hashlib
+import os
+import zipfile
+
+import numpy as np
+
+from instrument import timed
+
+# bump this whenever the way a Patient derives its arrays from the input files changes, so old entries are not used
+PARSER_VERSION = 3
+
+EVICT_TO = 0.9      # an eviction brings the cache down to this fraction of max_bytes, so it does not happen every save
+
+
+def file_fingerprint(path):
+    """Identify the content of a file by its path, size and modification time"""
+    st = os.stat(path)
+    return '%s|%d|%r' % (os.path.abspath(path), st.st_size, st.st_mtime)
+
+
+class PatientCache(object):
+    """Content addressed cache of per-patient arrays.
+    Each entry is a single .npz file named by a hash of the fingerprints of the input files and PARSER_VERSION, so
+    changing an input file (or the parser) simply misses the cache.  When the total size of the cache goes over
+    max_bytes the least recently used entries are removed, down to EVICT_TO of max_bytes.  The directory is only
+    scanned when the cache is created and when it has to evict, in between a running total of the bytes saved is kept
+    (by each process, so with several processes the cache can go over max_bytes by what the others saved until one
+    of them next evicts).
+    Args:
+        cache_dir: directory the entries are kept in, created if needed
+        max_bytes: upper bound on the total size of the entries, None for no bound
+    """
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = sum(size for mtime, size, name in self.entries()) if max_bytes is not None else 0
+
+    def key(self, paths):
+        """Cache key for the arrays derived from the files in paths"""
+        h = hashlib.sha1('v%d' % PARSER_VERSION)
+        for path in paths:
+            h.update('\n')
+            h.update(file_fingerprint(path))
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def contains(self, key):
+        return os.path.exists(self.entry_path(key))
+
+    @timed('cache.load')
+    def load(self, key):
+        """Return the dictionary of arrays stored under key, or None on a miss.  An entry that cannot be read is
+        removed and counts as a miss"""
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as data:
+                arrays = dict((k, data[k]) for k in data.files)
+        except (IOError, OSError):
+            return None
+        except (ValueError, KeyError, zipfile.BadZipfile, NotImplementedError):
+            # a corrupt entry (zipfile raises NotImplementedError for a mangled compression method), so a miss
+            self.discard(key)
+            return None
+
+        # mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return arrays
+
+    @timed('cache.save')
+    def save(self, key, arrays):
+        """Store the dictionary of arrays under key, then evict old entries if the cache is too big"""
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # write to a temporary file first so other processes never see a partial entry
+        path = self.entry_path(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+            size = f.tell()
+        try:
+            os.rename(tmp, path)
+            self.total_bytes += size
+        except OSError:
+            # another process got there first (on Windows rename will not replace an existing file)
+            os.remove(tmp)
+
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def discard(self, key):
+        """Remove the entry stored under key, e.g. one that cannot be read"""
+        path = self.entry_path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return      # already gone
+        if self.max_bytes is not None:
+            self.total_bytes = max(self.total_bytes - size, 0)
+
+    def entries(self):
+        """List of (modification time, size, file name) of the entries in the cache directory"""
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return []   # not created yet
+        entries = []
+        for name in names:
+            if not name.endswith('.npz'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue    # removed by another process
+            entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is no bigger than EVICT_TO of max_bytes"""
+        if self.max_bytes is None:
+            return
+
+        # rescan, as other processes may have saved or removed entries
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        if total <= self.max_bytes:
+            self.total_bytes = total
+            return
+        for mtime, size, name in sorted(entries):
+            if total <= EVICT_TO * self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+        self.total_bytes = total
@@ -0,0 +1,126 @@
+###########################################################
+# checkpoint.py
+# Define class Checkpoint, which keeps the rows of every
+# patient that has been processed so that an interrupted
+# (or partly changed) cohort run only redoes what is missing
+###########################################################
+
+import cPickle
+import errno
+import hashlib
+import json
+import os
+
+from cache import PARSER_VERSION, file_fingerprint
+from patient import input_files
+
+
+class Checkpoint(object):
+    """Per-patient results of a cohort run, kept on disk.
+    The strata of each finished patient are pickled to a part file and a line is appended to a manifest.  A patient
+    is finished if the manifest has an entry for it whose key matches its Task; the key covers the input files, the
+    study and NSVT times, the seed and the configurations, so a patient whose inputs changed is processed again.
+    A patient that fails gets a manifest entry holding the error instead, and is tried again on the next run.
+    The manifest is append only while patients are being processed, so a crash loses at most the line being written.
+    The parts are then assembled in task order, which is when the strata are numbered, leaving out the patients that
+    failed, and the manifest is rewritten with the range of strata each patient was given.
+    Args:
+        directory: directory the manifest and part files are kept in, created if needed
+    """
+    MANIFEST = 'manifest.jsonl'
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def manifest_path(self):
+        return os.path.join(self.directory, self.MANIFEST)
+
+    def part_path(self, pt_id):
+        return os.path.join(self.directory, pt_id + '.pkl')
+
+    def key(self, task):
+        """Identify everything the rows of a Task depend on"""
+        h = hashlib.sha1('v%d' % PARSER_VERSION)
+        for path in input_files(task.pt_id, task.xml_path):
+            h.update('\n')
+            h.update(file_fingerprint(path))
+        h.update('\n')
+        h.update(repr((task.pt_id, sorted(task.study_times.items()), task.start_time, task.nsvt_times, task.seed,
+                       task.configs)))
+        return h.hexdigest()
+
+    def entries(self):
+        """Dictionary of the manifest entries by patient id, the last entry of a patient wins"""
+        entries = {}
+        try:
+            f = open(self.manifest_path())
+        except IOError:
+            return entries
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue    # the last line of an interrupted run may be incomplete
+                entries[entry['pt_id']] = entry
+        return entries
+
+    def finished(self, tasks):
+        """The set of patient ids of tasks that already have up to date results"""
+        entries = self.entries()
+        finished = set()
+        for task in tasks:
+            if task.pt_id not in entries or not os.path.exists(self.part_path(task.pt_id)):
+                continue
+            try:
+                key = self.key(task)
+            except OSError:
+                continue    # an input file is missing, leave it to the patient to fail
+            if entries[task.pt_id]['key'] == key and 'error' not in entries[task.pt_id]:
+                finished.add(task.pt_id)
+        return finished
+
+    def save(self, task, config_strata):
+        """Keep the strata of a finished patient, one list of strata per Config"""
+        path = self.part_path(task.pt_id)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            cPickle.dump(config_strata, f, cPickle.HIGHEST_PROTOCOL)
+        if os.path.exists(path):
+            os.remove(path)     # on Windows rename will not replace an existing file
+        os.rename(tmp, path)
+
+        self.append_entry({'pt_id': task.pt_id, 'key': self.key(task),
+                           'n_strata': [len(strata) for strata in config_strata]})
+
+    def save_failure(self, task, error):
+        """Record that a patient failed, error being the formatted traceback"""
+        try:
+            key = self.key(task)
+        except OSError:
+            key = None      # an input file is missing
+        self.append_entry({'pt_id': task.pt_id, 'key': key, 'error': error})
+
+    def append_entry(self, entry):
+        with open(self.manifest_path(), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def load(self, pt_id):
+        """The strata saved for a patient"""
+        with open(self.part_path(pt_id), 'rb') as f:
+            return cPickle.load(f)
+
+    def write_manifest(self, entries):
+        """Replace the manifest with the list of entries"""
+        tmp = self.manifest_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+        if os.path.exists(self.manifest_path()):
+            os.remove(self.manifest_path())
+        os.rename(tmp, self.manifest_path())
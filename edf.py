@@ -1,7 +1,12 @@
-import pyedflib     # http://pyedflib.readthedocs.io/en/latest/
+import numpy as np
 
+from cStringIO import StringIO
 from datetime import datetime, timedelta
 
+from instrument import timed
+from signals import Signal, valid_range
+
+
 def signalname_to_dict(signalNames):
     res = {}
     index = 0
@@ -10,67 +15,218 @@ def signalname_to_dict(signalNames):
         index += 1
     return res
 
+def header_size(num_signals):
+    """Size in bytes of an EDF header describing num_signals signals"""
+    return (num_signals + 1) * 256
+
+def header_fields(data, num_signals, width, start):
+    """Split one of the per-signal fields of the EDF header into a list of stripped strings"""
+    return [data[start + i * width:start + (i + 1) * width].strip() for i in range(num_signals)]
+
 
 class EDF:
     """ EDF class docstring!
-    Loads the EDF file specified by filename into the instance.  If filename is not given, creates an empty instance
-    and .load must be called at some point in the future.
+    Opens the EDF file specified by filename.  Only the header is parsed when the file is opened.  The data records
+    are memory mapped, each channel is a strided view into the mapping, and samples are only read from disk (or the
+    OS page cache, shared with any other process mapping the same file) when they are used.  If filename is not given,
+    creates an empty instance and .load must be called at some point in the future.
+    Instead of a filename, the content of the file can be given as a string of bytes already in memory (e.g. read
+    ahead from a slow drive).  The channels are then views into those bytes rather than into a memory map.
+
+    The mapping is held until .close is called.  EDF can be used as a context manager to close it deterministically:
+        with EDF(filename) as a:
+            o2 = a.extractChannel('sao2')
     Args:
         filename: Properly escaped filename of the EDF file to load. Default is None
+        data: the bytes of an EDF file, used if filename is not given. Default is None
     """
-    f = None
+    data = None             # np.memmap (or array) of the data records, shape (n_records, record_samples)
     dur_sec = None
     channels = None
 
-    def __init__(self, filename=None):
+    header = None           # dictionary of the fixed part of the header
+    n_records = None        # number of data records in the file
+    record_duration = None  # seconds per data record
+    labels = None           # list of signal labels
+    samples_per_record = None   # list, number of samples of each signal in each data record
+    offsets = None          # list, sample offset of each signal within a data record
+    record_samples = None   # total number of samples in a data record
+    gains = None            # list, physical units per digital unit of each signal
+    zeros = None            # list, physical value of digital 0 for each signal
+
+    def __init__(self, filename=None, data=None):
+        if filename:
+            with open(filename, 'rb') as f:
+                self.readHeader(f)
+        elif data is not None:
+            # cStringIO reads from the string without copying it
+            self.readHeader(StringIO(data))
+        else:
+            return
+
+        self.channels = signalname_to_dict(self.labels)
+        self.dur_sec = self.n_records * self.record_duration
+        shape = (self.n_records, self.record_samples)
         if filename:
-            self.f = pyedflib.EdfReader(filename)
-            self.channels = signalname_to_dict(self.f.getSignalLabels())
-            self.dur_sec = self.f.getFileDuration()
+            self.data = np.memmap(filename, dtype='<i2', mode='r', offset=self.header['header_size'], shape=shape)
+        else:
+            self.data = np.frombuffer(data, dtype='<i2', count=shape[0] * shape[1],
+                                      offset=self.header['header_size']).reshape(shape)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def load(self, filename):
         """Load an EDF file into the instance.
-        Loads the specified EDF file into the instance. This file is stored internally as 'f' but should generally by
-        accessed via the available member functions.
+        Opens the specified EDF file and reads its header. The file is mapped internally as 'data' but should generally
+        be accessed via the available member functions.
         Args:
             filename: Properly escaped filename of the EDF file to load.
         """
-
+        self.close()
         self.__init__(filename)
 
+    def close(self):
+        """Release the file.
+        The mapping (or the bytes given as data) is released once the last view returned by rawChannel is also gone."""
+        self.data = None
+
+    def readHeader(self, f):
+        """Parse the EDF header (but none of the data records) from the open file f"""
+        f.seek(0)
+        head = f.read(256)
+        num_signals = int(head[252:256].rstrip())
+        self.header = {'version': head[0:8].strip(),
+                       'patient': head[8:88].strip(),
+                       'recording': head[88:168].strip(),
+                       'startdate': head[168:176].strip(),
+                       'starttime': head[176:184].strip(),
+                       'header_size': header_size(num_signals),
+                       'reserved': head[192:236].strip(),
+                       'num_signals': num_signals}
+        self.record_duration = float(head[244:252])
+
+        data = f.read(header_size(num_signals) - 256)
+        fields = []
+        start = 0
+        for width in (16, 80, 8, 8, 8, 8, 8, 80, 8, 32):
+            fields.append(header_fields(data, num_signals, width, start))
+            start += width * num_signals
+        self.labels = fields[0]
+        self.header['transducer'] = fields[1]
+        self.header['physical_dimension'] = fields[2]
+        physical_min = [float(v) for v in fields[3]]
+        physical_max = [float(v) for v in fields[4]]
+        digital_min = [float(v) for v in fields[5]]
+        digital_max = [float(v) for v in fields[6]]
+        self.header['prefilter'] = fields[7]
+        self.samples_per_record = [int(v) for v in fields[8]]
+
+        self.offsets = list(np.cumsum([0] + self.samples_per_record[:-1]))
+        self.record_samples = sum(self.samples_per_record)
+
+        # physical = (digital - digital_min) * gain + physical_min
+        self.gains = [(pmax - pmin) / (dmax - dmin)
+                      for pmin, pmax, dmin, dmax in zip(physical_min, physical_max, digital_min, digital_max)]
+        self.zeros = [pmin - dmin * g for pmin, dmin, g in zip(physical_min, digital_min, self.gains)]
+
+        # the number of records is allowed to be -1 (unknown) in the header, and the last record of some files is
+        # truncated, so never claim more records than there are in the file
+        f.seek(0, 2)
+        n_records = (f.tell() - header_size(num_signals)) // (2 * self.record_samples)
+        if int(head[236:244]) >= 0:
+            n_records = min(n_records, int(head[236:244]))
+        self.n_records = n_records
+
     def getOverview(self):
         """Prints a silly overview of the file.
         Not useful to run, but ok to help understand what is _in_ the loaded file"""
 
-        assert self.f is not None, "EDF not yet loaded..."
-
-        print("edfsignals: %i" % self.f.signals_in_file)
-        print("file duration: %i seconds" % self.f.file_duration)
-        print("startdate: %i-%i-%i" % (self.f.getStartdatetime().day, self.f.getStartdatetime().month, self.f.getStartdatetime().year))
-        print("starttime: %i:%02i:%02i" % (
-            self.f.getStartdatetime().hour, self.f.getStartdatetime().minute, self.f.getStartdatetime().second))
-        # print("patient: %s" % f.getP);
-        # print("recording: %s" % f.getPatientAdditional())
-        print("patientcode: %s" % self.f.getPatientCode())
-        print("gender: %s" % self.f.getGender())
-        print("birthdate: %s" % self.f.getBirthdate())
-        print("patient_name: %s" % self.f.getPatientName())
-        print("patient_additional: %s" % self.f.getPatientAdditional())
-        print("admincode: %s" % self.f.getAdmincode())
-        print("technician: %s" % self.f.getTechnician())
-        print("equipment: %s" % self.f.getEquipment())
-        print("recording_additional: %s" % self.f.getRecordingAdditional())
-        print("datarecord duration: %f seconds" % self.f.getFileDuration())
-        print("number of datarecords in the file: %i" % self.f.datarecords_in_file)
-        print("number of annotations in the file: %i" % self.f.annotations_in_file)
+        assert self.header is not None, "EDF not yet loaded..."
+
+        start = self.get_start_time()
+        print("edfsignals: %i" % self.header['num_signals'])
+        print("file duration: %i seconds" % self.dur_sec)
+        print("startdate: %i-%i-%i" % (start.day, start.month, start.year))
+        print("starttime: %i:%02i:%02i" % (start.hour, start.minute, start.second))
+        print("patient: %s" % self.header['patient'])
+        print("recording: %s" % self.header['recording'])
+        print("datarecord duration: %f seconds" % self.record_duration)
+        print("number of datarecords in the file: %i" % self.n_records)
+        for label, n in zip(self.labels, self.samples_per_record):
+            print("signal %s: %i samples per datarecord" % (label, n))
 
     def get_start_time(self):
-        return datetime(year=self.f.getStartdatetime().year,
-                        month=self.f.getStartdatetime().month,
-                        day=self.f.getStartdatetime().day,
-                        hour=self.f.getStartdatetime().hour,
-                        minute=self.f.getStartdatetime().minute,
-                        second=self.f.getStartdatetime().second)
+        [day, month, year] = [int(v) for v in self.header['startdate'].split('.')]
+        [hour, minute, second] = [int(v) for v in self.header['starttime'].split('.')]
+        # EDF dates only have 2 digit years, 85-99 are 1985-1999
+        year += 1900 if year >= 85 else 2000
+        return datetime(year=year, month=month, day=day, hour=hour, minute=minute, second=second)
+
+    def rawChannel(self, channelName):
+        """A zero copy view of a single channel's digital values.
+        Args:
+            channelName: string with the name of the channel. Name is case insensitive.
+        Returns:
+            Numpy array of int16 with shape (n_records, samples per record), a strided view into the memory map.
+        """
+
+        assert self.data is not None, "EDF not yet loaded..."
+
+        channelName = channelName.lower()
+        assert channelName in self.channels, "Channel Name is not in this EDF"
+        c = self.channels[channelName]  # get the ID number of the channel
+
+        return self.data[:, self.offsets[c]:self.offsets[c] + self.samples_per_record[c]]
+
+    @timed('edf.readChannel')
+    def readChannel(self, channelName, start=0, n=None):
+        """Read part of a single channel of data from the edf file.
+        Only the data records that hold samples [start, start + n) of the channel are touched, and of those only the
+        bytes that belong to the channel.
+        Args:
+            channelName: string with the name of the channel to load. Name is case insensitive.
+            start: index of the first sample to read
+            n: number of samples to read, None to read to the end of the channel
+        Returns:
+            Numpy N-dimensional array with ndim=1 of the samples in physical units.
+        """
+
+        raw = self.rawChannel(channelName)
+        c = self.channels[channelName.lower()]
+
+        spr = self.samples_per_record[c]
+        total = self.n_records * spr
+        stop = total if n is None else min(start + n, total)
+        if stop <= start:
+            return np.empty(0)
+
+        first = start // spr
+        last = (stop - 1) // spr
+        digital = raw[first:last + 1].ravel()[start - first * spr:stop - first * spr]
+
+        return digital * self.gains[c] + self.zeros[c]
+
+    def iterChannel(self, channelName, chunk_samples):
+        """Read a single channel a block at a time.
+        Only one block is in memory at once, so a whole night can be processed in constant memory.
+        Args:
+            channelName: string with the name of the channel to read. Name is case insensitive.
+            chunk_samples: number of samples in each block (the last one may be shorter)
+        Yields:
+            Tuples (index of the first sample of the block, Numpy array of the samples in physical units).
+        """
+        c = self.channels[channelName.lower()]
+        total = self.n_records * self.samples_per_record[c]
+        for start in xrange(0, total, chunk_samples):
+            yield start, self.readChannel(channelName, start, chunk_samples)
+
+    def sampleRate(self, channelName):
+        """Frequency (Hz) of a channel"""
+        return self.samples_per_record[self.channels[channelName.lower()]] / float(self.record_duration)
 
     def extractChannel(self,channelName):
         """Extract a single channel of data from the edf file.
@@ -82,17 +238,37 @@ class EDF:
             'sample_rate' frequency (Hz) of the recorded signal since each signal can be recorded at different rates.
         """
 
-        assert self.f is not None, "EDF not yet loaded..."
-
-        channelName = channelName.lower()
-        assert channelName in self.channels, "Channel Name is not in this EDF"
-        c = self.channels[channelName]  # get the ID number of the channel
-
-        r = {'signal': self.f.readSignal(c)}
+        r = {'signal': self.readChannel(channelName)}
         r['sample_rate'] = r['signal'].size / float(self.dur_sec)
 
         return r
 
+    def channelSignal(self, channelName, origin=None):
+        """A single channel as a signals.Signal, origin defaults to the start time of the recording"""
+        a = self.extractChannel(channelName)
+        return Signal(self.get_start_time() if origin is None else origin, a['signal'], a['sample_rate'])
+
+    def channel_stats(self, channelNames, periods, stats, valid_ranges=None):
+        """Summarize several channels over a batch of periods, see signals.Signal.window_stats.
+        Each channel is read once, whatever the number of periods and statistics.
+        Args:
+            channelNames: list of channel names. Names are case insensitive.
+            periods: array of shape (n, 2) of seconds since the start of the recording
+            stats: list of statistic names, e.g. ['min', 'mean', 'p90', 'masked_mean']
+            valid_ranges: optional dictionary of (lo, hi) by lower case channel name.  Samples outside are artifacts
+                and left out of the masked_ statistics
+        Returns:
+            Dictionary of arrays of shape (n, len(stats)) by channel name.
+        """
+        valid_ranges = valid_ranges or {}
+        result = {}
+        for name in channelNames:
+            signal = self.channelSignal(name)
+            bounds = valid_ranges.get(name.lower())
+            valid = None if bounds is None else valid_range(signal.values, bounds)
+            result[name] = signal.window_stats(periods, stats, valid)
+        return result
+
     def getHeaderSize(self, filename):
         """Gets the size of the EDF file's header
         There's really no reason to use this other than cleanHeader()"""
@@ -100,8 +276,7 @@ class EDF:
         with open(filename, 'rb') as f:
             head = f.read(252)
             num_signals = int(f.read(4).rstrip())
-            header_size = (num_signals + 1) * 256
-        return header_size
+        return header_size(num_signals)
 
     def cleanHeader(self, filename):
         """Cleans the EDF file's header of non-standard ASCII characters.
@@ -143,4 +318,3 @@ class EDF:
             out.append( (ts+timedelta(seconds=i*dt_sec), v) )
             i += 1
         return out
-
@@ -0,0 +1,178 @@
+###########################################################
+# events.py
+# Define class EventTable which holds a set of scored events
+# (PLM, arousals, respiratory events...) as columns of
+# seconds since the start of the study
+###########################################################
+
+import datetime
+
+import numpy as np
+
+from association import expand_ranges
+
+class EventTable(object):
+    """A set of events stored as parallel NumPy arrays.
+    Start and end times are float64 seconds since origin (the study start time) and the events are kept sorted by
+    start time.  An optional integer code column can be used to tag each event with a category (e.g. the type of a
+    respiratory event).  Periods passed to the queries may be given either as datetimes or as seconds since origin;
+    events are only converted back to wall time when iterated or indexed.
+
+    The running maximum of the end times is kept alongside the sorted starts.  Together they form an interval index:
+    the events overlapping a period are found with two binary searches, so queries are O(log n + k) rather than a
+    scan of the whole night.
+    Args:
+        origin: datetime that time 0 refers to
+        starts: sequence of event start times, seconds since origin
+        ends: sequence of event end times, seconds since origin
+        codes: optional sequence of integer category codes, one per event
+    """
+    __slots__ = ('origin', 'starts', 'ends', 'codes', 'max_ends')
+
+    def __init__(self, origin, starts=(), ends=(), codes=None):
+        # times are held to the microsecond, the same resolution as a datetime, so that boundary comparisons give
+        # the same answer as they would in wall time
+        starts = np.round(np.asarray(starts, dtype=np.float64), 6)
+        ends = np.round(np.asarray(ends, dtype=np.float64), 6)
+        if codes is not None:
+            codes = np.asarray(codes, dtype=np.int32)
+
+        # keep the events ordered by start time.  mergesort is stable so events that start together keep the order
+        # in which they were given
+        if starts.size > 1 and np.any(starts[1:] < starts[:-1]):
+            order = np.argsort(starts, kind='mergesort')
+            starts = starts[order]
+            ends = ends[order]
+            if codes is not None:
+                codes = codes[order]
+
+        self.origin = origin
+        self.starts = starts
+        self.ends = ends
+        self.codes = codes
+        self.max_ends = np.maximum.accumulate(ends) if ends.size else ends
+
+    @classmethod
+    def from_arrays(cls, origin, arrays, name):
+        """Rebuild an EventTable saved with to_arrays"""
+        return cls(origin, arrays[name + '_starts'], arrays[name + '_ends'], arrays.get(name + '_codes'))
+
+    def to_arrays(self, name):
+        """Dictionary of the columns of the table, keyed by name + '_starts' etc, e.g. for np.savez"""
+        arrays = {name + '_starts': self.starts, name + '_ends': self.ends}
+        if self.codes is not None:
+            arrays[name + '_codes'] = self.codes
+        return arrays
+
+    @classmethod
+    def concat(cls, origin, tables):
+        """Join several EventTables that share the same origin into a single, sorted, table"""
+        tables = list(tables)
+        if not tables:
+            return cls(origin)
+
+        codes = None
+        if all(t.codes is not None for t in tables):
+            codes = np.concatenate([t.codes for t in tables])
+        return cls(origin,
+                   np.concatenate([t.starts for t in tables]),
+                   np.concatenate([t.ends for t in tables]),
+                   codes)
+
+    def __len__(self):
+        return self.starts.size
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        return (self.to_walltime(self.starts[index]), self.to_walltime(self.ends[index]))
+
+    def __contains__(self, event):
+        ts = self.to_seconds(event[0])
+        te = self.to_seconds(event[1])
+        return bool(np.any((self.starts == ts) & (self.ends == te)))
+
+    def to_seconds(self, when):
+        if isinstance(when, datetime.datetime):
+            return (when - self.origin).total_seconds()
+        return float(when)
+
+    def to_walltime(self, seconds):
+        return self.origin + datetime.timedelta(seconds=float(seconds))
+
+    def subset(self, mask):
+        """Return a new EventTable holding only the events selected by mask (boolean or index array)"""
+        return EventTable(self.origin,
+                          self.starts[mask],
+                          self.ends[mask],
+                          None if self.codes is None else self.codes[mask])
+
+    def _bounds(self, period):
+        """Find the slice [lo, hi) of events that can overlap period.
+        Every event at or past hi starts after the period ends, and every event before lo (and all that start before
+        it) ends before the period starts.  The event at lo, if lo < hi, is guaranteed to overlap the period."""
+        t0 = self.to_seconds(period[0])
+        t1 = self.to_seconds(period[1])
+        hi = int(np.searchsorted(self.starts, t1, side='right'))
+        lo = int(np.searchsorted(self.max_ends, t0, side='left'))
+        return lo, hi, t0
+
+    def during_index(self, period):
+        """Indices of the events that overlap period.
+        An event overlaps if either of its ends fall within the period, or if the period starts within the event.
+        All of the boundaries are inclusive."""
+        lo, hi, t0 = self._bounds(period)
+        if lo >= hi:
+            return np.empty(0, dtype=np.intp)
+        return lo + np.flatnonzero(self.ends[lo:hi] >= t0)
+
+    def any_during(self, period):
+        lo, hi, t0 = self._bounds(period)
+        return lo < hi
+
+    def count_during(self, period):
+        lo, hi, t0 = self._bounds(period)
+        if lo >= hi:
+            return 0
+        return int(np.count_nonzero(self.ends[lo:hi] >= t0))
+
+    def get_during(self, period):
+        return self.subset(self.during_index(period))
+
+    # The _batch queries answer the query of the same name for many periods at once.  periods is an array of shape
+    # (n, 2) of seconds since origin (not datetimes) and the result has one row per period.
+
+    def _bounds_batch(self, periods):
+        periods = np.asarray(periods, dtype=np.float64).reshape(-1, 2)
+        hi = np.searchsorted(self.starts, periods[:, 1], side='right')
+        lo = np.searchsorted(self.max_ends, periods[:, 0], side='left')
+        return lo, hi, periods[:, 0]
+
+    def during_pairs(self, periods):
+        """Every (period, event) pair such that the event overlaps the period, as two index arrays (p, j).
+        The pairs are ordered by period and then event, so the events of each period are in the order get_during
+        would give them."""
+        lo, hi, t0 = self._bounds_batch(periods)
+        p, j = expand_ranges(lo, hi)
+        keep = self.ends[j] >= t0[p]
+        return p[keep], j[keep]
+
+    def any_during_batch(self, periods):
+        lo, hi, t0 = self._bounds_batch(periods)
+        return lo < hi
+
+    def count_during_batch(self, periods):
+        p, j = self.during_pairs(periods)
+        return np.bincount(p, minlength=len(periods))
+
+    def first_during_batch(self, periods, k):
+        """Indices of the first k events that overlap each period, as an array of shape (n, k) padded with -1"""
+        p, j = self.during_pairs(periods)
+        # rank of each event among those of its period
+        rank = np.arange(p.size) - np.searchsorted(p, p, side='left')
+        keep = rank < k
+        first = np.full((len(periods), k), -1, dtype=np.intp)
+        first[p[keep], rank[keep]] = j[keep]
+        return first
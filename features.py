@@ -0,0 +1,69 @@
+###########################################################
+# features.py
+# Compute the per-period columns of the output (PLM, resp,
+# arousal, SaO2 and desaturation measures) for many periods
+# at once, so that writing the rows is only a matter of
+# formatting
+###########################################################
+
+import numpy as np
+
+from instrument import timed, count
+
+N_PLMS_TYPES = 5    # PLMS_type1 .. PLMS_type5
+N_RESP_TYPES = 2    # resp_type1 .. resp_type2
+
+
+def event_labels(events, first, labels):
+    """Look up the label of the events listed in first (an index array padded with -1), 0 where there is no event"""
+    if len(events) == 0:
+        return np.zeros(first.shape, dtype=np.int32)
+    return np.where(first >= 0, labels[np.maximum(first, 0)], 0)
+
+@timed('features.compute_period_features')
+def compute_period_features(pt, periods):
+    """Compute every per-period output column for a batch of periods of a patient.
+
+    :param pt: Patient
+    :param periods: sequence of tuples of times (seconds since start of study), or an array of shape (n, 2)
+    :return: dictionary of arrays with one row per period, keyed by output column name.  'PLMS_type' and 'resp_type'
+             have one column per PLMS_typeN / resp_typeN.  'minsat' is inf where there is no valid SaO2 sample.
+             'PLMS_periodic' (the number of PLMs that are part of a periodic series), 'desat3' and 'desat4' (the number
+             of 3% and 4% desaturations) are not written to the results
+    """
+    periods = np.asarray(periods, dtype=np.float64).reshape(-1, 2)
+    count('periods', len(periods))
+    features = {}
+
+    # epoch and sleep stage at the start of each period
+    epochs = np.floor(periods[:, 0] / 30.0).astype(np.int64) + 1
+    features['epoch_number'] = epochs
+    features['sleep_stage'] = np.asarray(pt.sleep_list)[epochs - 1]
+
+    # PLMs are labelled by whether they are associated with an arousal, see PLM_CODES
+    features['PLMS_event'] = pt.plm_events.any_during_batch(periods).astype(np.int32)
+    features['PLMS_type'] = event_labels(pt.plm_events,
+                                         pt.plm_events.first_during_batch(periods, N_PLMS_TYPES),
+                                         pt.plm_events.codes)
+    features['PLMS_periodic'] = pt.plm_events.subset(pt.plm_series >= 0).count_during_batch(periods)
+
+    # respiratory events are labelled by their type code
+    features['resp_event'] = pt.resp_events.any_during_batch(periods).astype(np.int32)
+    features['resp_type'] = event_labels(pt.resp_events,
+                                         pt.resp_events.first_during_batch(periods, N_RESP_TYPES),
+                                         pt.resp_events.codes)
+
+    features['arousal'] = pt.arousal_events.count_during_batch(periods)
+    features['PLMS_assos'] = pt.arousal_plm.count_during_batch(periods)
+    features['resp_assos'] = pt.arousal_resp.count_during_batch(periods)
+
+    if pt.o2_sat is None:
+        # the EDF has no sao2 channel
+        features['minsat'] = np.full(len(periods), np.inf)
+    else:
+        i0, i1 = pt.o2_sat.index_bounds_batch(periods)
+        features['minsat'] = pt.o2_min.min_batch(i0, i1)
+    features['desat3'] = pt.desat3_events.count_during_batch(periods)
+    features['desat4'] = pt.desat4_events.count_during_batch(periods)
+
+    return features
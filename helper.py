@@ -1,18 +1,32 @@
 import datetime
 import os
 import re
+from xml.etree.cElementTree import iterparse
 
-from plm import Plm
+from instrument import timed
+from plm import PLM_SIDES, plm_array
+
+# Inside a Patient every time is a float number of seconds since the start of the study.  datetimes are only used
+# when reading the input files and writing the results.
+SECONDS_PER_DAY = 24 * 60 * 60
+
+def round_us(seconds):
+    """Round a time in seconds to the microsecond, the resolution of a datetime, so that sums of times compare
+    exactly"""
+    return round(seconds, 6)
 
 def clock_to_datetime(clock_str):
     [h, m, s] = clock_str.split(':')
     return datetime.datetime(2000, 1, 1, int(h), int(m), int(s))
 
 def make_after(before, after):
-    if after < before:
-        return after + datetime.timedelta(days=1)
-    else:
-        return after
+    """Move after forward by whole days until it is no earlier than before.
+    Clock times carry no date, so this is how a time after midnight is placed after one before it.  Works on datetimes
+    or on seconds."""
+    day = datetime.timedelta(days=1) if isinstance(after, datetime.datetime) else SECONDS_PER_DAY
+    while after < before:
+        after += day
+    return after
 
 def get_study_start_time(file):
     """For some reason the study start times are stored in NSVT times file as the first element"""
@@ -45,11 +59,11 @@ def get_sleep_times(file):
     return result
 
 def create_even_chunks(ts, tf):
-    dt = float((tf - ts).seconds)        # how many seconds is the sleep period
+    dt = float(tf - ts)             # how many seconds is the sleep period
     ideal_chunk = 30 * 60           # ideal chunk is 30 min long
     n_chunks = int(dt / ideal_chunk)
     dt_chunk = dt / n_chunks
-    return datetime.timedelta(seconds=dt_chunk)
+    return round_us(dt_chunk)
 
 def getFileNames(searchdir, fileType):
     filelist = []
@@ -83,7 +97,7 @@ def get_NSVT_times(file):
             new_times.append(times[0])
             for i in range(1, len(times)):
                 dt = times[i] - times[i-1]
-                if dt.seconds >= 5*60:
+                if dt.total_seconds() >= 5*60:
                     new_times.append(times[i])
 
             result[pt_id] = new_times
@@ -91,13 +105,13 @@ def get_NSVT_times(file):
     return result
 
 def chunk_times(time, ts, tf, dt_chunk):
-    chunk = (ts, ts + dt_chunk)
+    chunk = (ts, round_us(ts + dt_chunk))
     if time < ts or time > tf:
         return None
-    while chunk[1] <= tf+datetime.timedelta(seconds=1):
+    while chunk[1] <= round_us(tf + 1):
         if time < chunk[1]:
             return chunk
-        chunk = (chunk[0]+dt_chunk, chunk[1]+dt_chunk)
+        chunk = (round_us(chunk[0] + dt_chunk), round_us(chunk[1] + dt_chunk))
 
 def make_fit_within(small, big):
     result = small
@@ -109,65 +123,116 @@ def make_fit_within(small, big):
 
 def get_control_windows(nsvt_onset, chunk_times, window_width, interval):
     windows = []
-    half_width = datetime.timedelta(seconds=float(window_width / 2))
-    interval = datetime.timedelta(seconds=interval)
+    half_width = round_us(float(window_width / 2))
 
     # work backwards in time from nsvt_onset
-    t = nsvt_onset - interval
-    while t >= chunk_times[0]-half_width:
-        window = make_fit_within((t-half_width, t+half_width), chunk_times)
+    t = round_us(nsvt_onset - interval)
+    while t >= round_us(chunk_times[0] - half_width):
+        window = make_fit_within((round_us(t - half_width), round_us(t + half_width)), chunk_times)
         windows.append(window)
-        t = t - interval
+        t = round_us(t - interval)
 
     # work forwards in time from nsvt_onset
-    t = nsvt_onset + interval
-    while t <= chunk_times[1]+half_width:
-        window = make_fit_within((t-half_width, t+half_width), chunk_times)
+    t = round_us(nsvt_onset + interval)
+    while t <= round_us(chunk_times[1] + half_width):
+        window = make_fit_within((round_us(t - half_width), round_us(t + half_width)), chunk_times)
         windows.append(window)
-        t = t + interval
+        t = round_us(t + interval)
 
     return windows
 
-def get_sleep_stages(xml_path, fname):
-    re_ss = re.compile(ur'<SleepStage>(\d+?)<\/SleepStage>')
-    sleep_list = []
-    with open(xml_path + '\\' + fname, 'r') as f:
-        data = f.read()
-        for ss in re.finditer(re_ss, data):
-            sleep_list.append(int(ss.group(1)))
-
-    return sleep_list
-
-def plm_from_xml(xml):
-    # <ScoredEvent><Name>PLM (Right)</Name><Start>818.4</Start><Duration>1.7</Duration><Input>Leg R</Input></ScoredEvent>
-    re_start = re.compile(ur'<Start>(\d*\.*\d*)<\/Start>')
-    re_dur = re.compile(ur'<Duration>(\d*\.*\d*)<\/Duration>')
-    re_side = re.compile(ur'PLM \((\w+?)\)')
-
-    tstart = float(re.search(re_start,xml).group(1))
-    dur = float(re.search(re_dur,xml).group(1))
-    tend = tstart + dur
-    side = re.search(re_side,xml).group(1)
-
-    event = Plm(tstart, tend, side)
-    return event
-
-def simple_event_from_xml(xml):
-    # <ScoredEvent><Name>Arousal (ASDA)</Name><Start>5444.5</Start><Duration>4.9</Duration><Input>C3</Input></ScoredEvent>
-    re_start = re.compile(ur'<Start>(\d*\.*\d*)<\/Start>')
-    re_dur = re.compile(ur'<Duration>(\d*\.*\d*)<\/Duration>')
+RESP_EVENT_NAMES = {'ca': "Central Apnea",
+                    'ma': "Mixed Apnea",
+                    'oa': "Obstructive Apnea",
+                    'h':  "(Central |Mixed |Obstructive)*Hypopnea"
+                    }
+RESP_CODES = {'oa': 1,      # category codes used for respiratory events, these are also the resp_type output values
+              'h': 2,
+              'ca': 3,
+              'ma': 4
+              }
+PLM_CODES = {'plm': 1,      # category codes used for PLM events, these are also the PLMS_type output values
+             'plma': 2      # associated with an arousal
+             }
+
+@timed('helper.read_annotations')
+def read_annotations(xml_path, fname, f=None):
+    """Read every annotation we use from the NSRR .XML file in a single pass
+
+    The file is streamed with iterparse and each <ScoredEvent>/<SleepStage> element is discarded as soon as it has
+    been read, so memory use does not grow with the size of the document.
+
+    :param xml_path: path to the XML files
+    :param fname: name of the .XML file for this patient
+    :param f: optional file-like object to read the XML from instead, e.g. the bytes of the file already in memory
+    :return: dictionary with 'sleep_stages' (list of ints, one per epoch), 'plm' (structured array of plm.PLM_DTYPE),
+             'arousal' (list of tuples) and 'resp' (dictionary of list of tuples keyed as RESP_EVENT_NAMES).  All times
+             are seconds since the start of the recording.
+    """
+    if f is None:
+        with open(os.path.join(xml_path, fname), 'rb') as f:
+            return parse_annotations(f)
+    return parse_annotations(f)
+
+def event_times(elem):
+    """Start and end (seconds since the start of the recording) of a <ScoredEvent> element"""
+    tstart = float(elem.findtext('Start'))
+    return tstart, tstart + float(elem.findtext('Duration'))
+
+def parse_annotations(f):
+    """The work of read_annotations, on the open file f"""
+    re_side = re.compile(r'PLM \((\w+?)\)')
+    re_resp = dict((k, re.compile(v)) for k, v in RESP_EVENT_NAMES.iteritems())
+
+    # the PLMs are collected as columns.  A side other than Left or Right gets a code of its own
+    plm_columns = ([], [], [])
+    sides = dict(PLM_SIDES)
+
+    result = {'sleep_stages': [],
+              'arousal': [],
+              'resp': dict((k, []) for k in RESP_EVENT_NAMES)}
+
+    parents = []
+    for action, elem in iterparse(f, events=('start', 'end')):
+        if action == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+
+        if elem.tag == 'SleepStage':
+            result['sleep_stages'].append(int(elem.text))
+        elif elem.tag == 'ScoredEvent':
+            # only the events we keep need a Start and a Duration, other events may have neither
+            name = elem.findtext('Name', '')
+            if name.startswith('PLM'):
+                tstart, tend = event_times(elem)
+                side = re_side.search(name)
+                side = side.group(1) if side else None
+                plm_columns[0].append(tstart)
+                plm_columns[1].append(tend)
+                plm_columns[2].append(sides.setdefault(side, len(sides)))
+            elif name.startswith('Arousal'):
+                result['arousal'].append(event_times(elem))
+            else:
+                for k, v in re_resp.iteritems():
+                    if v.match(name):
+                        result['resp'][k].append(event_times(elem))
+                        break
+        else:
+            continue
 
-    tstart = float(re.search(re_start,xml).group(1))
-    dur = float(re.search(re_dur,xml).group(1))
-    tend = tstart + dur
+        # the element has been consumed, drop it from the tree
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
 
-    event = (tstart, tend)
-    return event
+    result['plm'] = plm_array(*plm_columns)
+    return result
 
 def plm_arousal_associated(plm, arousal, constraint=(0,0.5)):
     # if the time of the arousal +/- the constraint overlaps with any of the plm, then true
-    ts = arousal[0] - abs(datetime.timedelta(seconds=constraint[0]))
-    te = arousal[1] + abs(datetime.timedelta(seconds=constraint[1]))
+    ts = round_us(arousal[0] - abs(constraint[0]))
+    te = round_us(arousal[1] + abs(constraint[1]))
 
     if plm[0] <= te and plm[0] >= ts:
         return True
@@ -207,7 +272,7 @@ def is_associated(event1, event2, constraint=(None,0.5), fixedOrder=False):
     if constraint[0] is None:
         c1 = True
     else:
-        if e2[0] - e1[1] > datetime.timedelta(seconds=constraint[0]):
+        if round_us(e2[0] - e1[1]) > constraint[0]:
             c1 = True
         else:
             return False
@@ -216,79 +281,39 @@ def is_associated(event1, event2, constraint=(None,0.5), fixedOrder=False):
     if constraint[1] is None:
         return True # this is basically return c1 and True which is return c1 which has to be True since we are here
     else:
-        if e2[0] - e1[1] < datetime.timedelta(seconds=constraint[1]):
+        if round_us(e2[0] - e1[1]) < constraint[1]:
             return True
         else:
             return False
 
-def dict_to_list(event_list, dict):
-    if isinstance(event_list, dict):
-        a = []
-        for k, v in event_list.iteritems():
-            for event in v:
-                a.append(event)
-        return a
-    else:
-        return event_list
-
+@timed('helper.any_during')
 def any_during(event_list, period):
-    event_list = dict_to_list(event_list, dict)
-
-    for event in event_list:
-        if event[0] >= period[0] and event[0] <= period[1]:
-            return True
-        if event[1] >= period[0] and event[1] <= period[1]:
-            return True
-        if period[0] >= event[0] and period[0] <= event[1]:
-            return True
-    return False
+    return event_list.any_during(period)
 
+@timed('helper.count_during')
 def count_during(event_list, period):
-    event_list = dict_to_list(event_list, dict)
-
-    n = 0
-    for event in event_list:
-        if any_during([event], period):
-            n += 1
-    return n
+    return event_list.count_during(period)
 
+@timed('helper.get_during')
 def get_during(event_list, period):
-    event_list = dict_to_list(event_list, dict)
-
-    subset = []
-    for event in event_list:
-        if any_during([event], period):
-            subset.append(event)
-    return subset
+    return event_list.get_during(period)
 
+@timed('helper.plms_type')
 def plms_type(pt, plm_list, index):
     if index < len(plm_list):
-        plm = plm_list[index]
-        if plm in pt.plma_events:
-            return 2
-        else:
-            return 1
+        return int(plm_list.codes[index])
     return 0
 
+@timed('helper.resp_type')
 def resp_type(pt, resp_list, index):
     if index < len(resp_list):
-        resp = resp_list[index]
-        if resp in pt.resp_events['oa']:
-            return 1
-        elif resp in pt.resp_events['h']:
-            return 2
-        elif resp in pt.resp_events['ca']:
-            return 3
-        elif resp in pt.resp_events['ma']:
-            return 4
-        else:
-            return -999
+        return int(resp_list.codes[index])
     return 0
 
 def remove_close_events(events, min_sec_between):
     new_list = [events[0]]
     for i in range(1, len(events)):
-        if events[i] - events[i-1] >= datetime.timedelta(seconds=min_sec_between):
+        if round_us(events[i] - events[i-1]) >= min_sec_between:
             new_list.append(events[i])
     return new_list
 
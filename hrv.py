@@ -0,0 +1,197 @@
+###########################################################
+# hrv.py
+# Streaming R-peak detection on the ECG channel of an EDF
+# file, and the time-domain heart rate variability (mean RR,
+# SDNN, RMSSD) of the RR intervals over batches of periods
+###########################################################
+
+import numpy as np
+
+from instrument import timed
+from signals import prefix_sum
+
+CHUNK_SECONDS = 60      # seconds of ECG read at once
+RR_MIN = 0.3            # RR intervals outside [RR_MIN, RR_MAX] seconds are missed or extra beats
+RR_MAX = 2.0
+
+
+class RPeakDetector(object):
+    """Find the R peaks of an ECG fed to it a block at a time, after Pan and Tompkins.
+    The ECG is band passed (a short moving average less a long one, which also removes the baseline wander), and the
+    QRS energy is its squared slope averaged over window seconds.  A local maximum of the energy is a beat if it is
+    above the noise level (the median energy of the block) by threshold times the gap between the noise and the
+    running level of the accepted beats, and at least refractory seconds after the previous beat.  The R peak is the
+    sample of the energy window furthest from the baseline.  Only about a second of ECG is carried over from one
+    block to the next, so the memory used does not grow with the recording.
+        detector = RPeakDetector(256)
+        for start, samples in edf.iterChannel('ecg', 256 * 60):
+            peaks.append(detector.feed(start, samples))
+        peaks.append(detector.finish())
+    Args:
+        sample_rate: frequency (Hz) of the ECG
+        window: seconds of the QRS energy window
+        refractory: shortest time (seconds) between two beats
+        threshold: fraction of the gap between the noise and the beats an energy peak must reach
+        learning: weight of each new beat in the running level
+        smooth: seconds of the short moving average
+        baseline: seconds of the long moving average
+    """
+    def __init__(self, sample_rate, window=0.15, refractory=0.25, threshold=0.25, learning=0.125,
+                 smooth=0.025, baseline=0.2):
+        self.sample_rate = float(sample_rate)
+        self.w = max(1, int(round(window * sample_rate)))
+        self.refractory = max(1, int(round(refractory * sample_rate)))
+        self.threshold = threshold
+        self.learning = learning
+        self.h_smooth = int(round(smooth * sample_rate / 2))     # half widths of the centred moving averages
+        self.h_baseline = max(self.h_smooth + 1, int(round(baseline * sample_rate / 2)))
+
+        self.level = None           # running energy of the accepted beats, set from the first block with a signal
+        self.last_peak = None       # sample index of the last beat
+        self.tail = np.empty(0)     # samples carried over from the previous block
+        self.tail_start = 0         # sample index of tail[0]
+        self.next_index = 0         # energy peaks before this sample have been dealt with
+
+    def feed(self, start, samples):
+        """Add the block of samples starting at sample index start (the blocks must follow each other).
+        Returns the array of sample indices of the R peaks that are settled so far"""
+        if not self.tail.size:
+            self.tail_start = start
+        return self.detect(np.concatenate((self.tail, np.asarray(samples, dtype=np.float64))), final=False)
+
+    def finish(self):
+        """Returns the sample indices of the R peaks left at the end of the recording"""
+        return self.detect(self.tail, final=True)
+
+    def detect(self, buf, final):
+        start = self.tail_start
+        w, h = self.w, self.h_baseline
+        n = buf.size
+        # sample start + i of the buffer is filtered if h <= i < n - h, its energy if in addition i >= h + w
+        if n - 2 * h - w < 3:
+            self.tail = buf
+            return np.empty(0, dtype=np.intp)
+
+        sums = prefix_sum(buf)
+        def moving_average(half):
+            return (sums[2 * half + 1:] - sums[:-2 * half - 1])[h - half:n - h - half] / (2 * half + 1)
+        baseline = moving_average(h)                # i = h .. n - h - 1
+        band = moving_average(self.h_smooth) - baseline
+        slope = prefix_sum(np.diff(band) ** 2)
+        energy = (slope[w:] - slope[:-w]) / w       # energy[k] is at sample start + h + w + k
+        offset = start + h + w
+
+        noise = np.median(energy)
+        if self.level is None:
+            # a flat start (e.g. before the leads are on) gives no level, wait for a block with some signal
+            top = np.percentile(energy, 99)
+            self.level = top if top > noise else None
+
+        # energy peaks that are settled: their right neighbour and the refractory time after them are in this block
+        limit = start + n - h if final else start + n - h - self.refractory
+        k = np.flatnonzero((energy[1:-1] > energy[:-2]) & (energy[1:-1] >= energy[2:])) + 1
+        k = k[(offset + k >= self.next_index) & (offset + k < limit)]
+        if self.level is not None:
+            # the level only moves by a fraction per beat, so half the threshold is a safe prefilter
+            k = k[energy[k] >= noise + 0.5 * self.threshold * (self.level - noise)]
+        else:
+            k = k[:0]
+
+        # R peak of each candidate: the sample furthest from the baseline in its energy window, or up to half a window
+        # after it in case the energy first peaked with only the start of the QRS in the window
+        i = np.minimum(k[:, None] + np.arange(h + 1, h + w + w // 2 + 1), n - h - 1)   # buffer indices
+        r = start + i[np.arange(k.size), np.argmax(np.abs(buf[i] - baseline[i - h]), axis=1)]
+
+        # the energy of a QRS is a noisy plateau a window long, its level is the top of the plateau
+        top = energy[np.minimum(k[:, None] + np.arange(w), energy.size - 1)].max(axis=1)
+
+        peaks = []
+        for height, level, peak in zip(energy[k].tolist(), top.tolist(), r.tolist()):
+            if height < noise + self.threshold * (self.level - noise):
+                continue
+            if self.last_peak is not None and peak - self.last_peak < self.refractory:
+                continue
+            peaks.append(peak)
+            self.last_peak = peak
+            self.level += self.learning * (level - self.level)
+
+        # keep enough samples to filter the first unsettled sample and to compare its energy with the one before
+        self.next_index = limit
+        keep = max(limit - 2 * h - w - 2, start)
+        self.tail = buf[keep - start:]
+        self.tail_start = keep
+        return np.array(peaks, dtype=np.intp)
+
+
+@timed('hrv.detect_r_peaks')
+def detect_r_peaks(edf, channel='ecg', chunk_seconds=CHUNK_SECONDS, **kwargs):
+    """Times (seconds since the start of the recording) of the R peaks of the ECG channel of an open EDF.
+    The channel is read chunk_seconds at a time, other keyword arguments are passed to RPeakDetector"""
+    sample_rate = edf.sampleRate(channel)
+    detector = RPeakDetector(sample_rate, **kwargs)
+    peaks = [detector.feed(start, samples)
+             for start, samples in edf.iterChannel(channel, int(chunk_seconds * sample_rate))]
+    peaks.append(detector.finish())
+    return np.concatenate(peaks) / sample_rate
+
+
+class RRSeries(object):
+    """The RR intervals between successive beats.
+    Interval i runs from beat i to beat i + 1.  Intervals outside [rr_min, rr_max] seconds (a missed or an extra
+    beat) are kept in place but left out of every statistic, as are the successive differences next to them.
+    Args:
+        beat_times: sorted array of the times of the beats, in seconds
+        rr_min, rr_max: bounds of the plausible intervals, in seconds
+    """
+    __slots__ = ('beat_times', 'rr', 'valid')
+
+    def __init__(self, beat_times, rr_min=RR_MIN, rr_max=RR_MAX):
+        self.beat_times = np.asarray(beat_times, dtype=np.float64)
+        self.rr = np.diff(self.beat_times)
+        self.valid = (self.rr >= rr_min) & (self.rr <= rr_max)
+
+    def __len__(self):
+        return self.rr.size
+
+    def interval_bounds(self, periods):
+        """Indices [i0, i1) of the intervals that lie wholly within each row of an array of shape (n, 2)"""
+        periods = np.asarray(periods, dtype=np.float64).reshape(-1, 2)
+        i0 = np.searchsorted(self.beat_times[:-1], periods[:, 0], 'left')
+        i1 = np.searchsorted(self.beat_times[1:], periods[:, 1], 'left')
+        return i0, np.maximum(i1, i0)
+
+    def hrv(self, periods):
+        """Time-domain HRV of each of a batch of periods, from prefix sums so the cost is constant per period.
+
+        :param periods: array of shape (n, 2) of seconds, in the time base of the beats
+        :return: dictionary of arrays of length n: 'n_rr' (number of valid intervals), 'mean_rr', 'sdnn' (sample
+                 standard deviation of the intervals) and 'rmssd' (root mean square of the successive differences),
+                 all in seconds and NaN where a period has too few intervals
+        """
+        i0, i1 = self.interval_bounds(periods)
+        valid = self.valid
+        # centre on the overall mean so the sums of squares do not lose precision
+        centre = self.rr[valid].mean() if valid.any() else 0.0
+        x = np.where(valid, self.rr - centre, 0.0)
+
+        def window_sum(values, lo, hi):
+            sums = prefix_sum(values)
+            return sums[hi] - sums[lo]
+
+        n = window_sum(valid, i0, i1)
+        s1 = window_sum(x, i0, i1)
+        s2 = window_sum(x * x, i0, i1)
+
+        # difference k is between intervals k and k + 1, so a period holds differences [i0, i1 - 1)
+        both = valid[1:] & valid[:-1]
+        d2 = np.where(both, np.diff(self.rr) ** 2, 0.0)
+        j1 = np.maximum(i1 - 1, i0)
+        n_d = window_sum(both, i0, j1)
+        sum_d2 = window_sum(d2, i0, j1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, centre + s1 / n, np.nan)
+            sdnn = np.where(n > 1, np.sqrt(np.maximum(s2 - s1 * s1 / n, 0.0) / (n - 1)), np.nan)
+            rmssd = np.where(n_d > 0, np.sqrt(sum_d2 / n_d), np.nan)
+        return {'n_rr': n.astype(np.intp), 'mean_rr': mean, 'sdnn': sdnn, 'rmssd': rmssd}
+
@@ -1,17 +1,12 @@
-import random
-
-from patient import Patient
 from helper import get_sleep_times, \
-    create_even_chunks, \
     get_NSVT_times, \
-    chunk_times, \
-    get_control_windows,\
-    get_study_start_time,\
-    any_during,\
-    get_during,\
-    count_during,\
-    plms_type,\
-    resp_type
+    get_study_start_time
+import instrument
+from cache import PatientCache
+from checkpoint import Checkpoint
+from pipeline import Config, Task, patient_seeds, run, update_checkpoint, assemble
+from prefetch import Prefetcher
+from writer import open_writer
 
 ROOT_DIR = 'F:\\MrOS PLM case-cross\\other'
 DATA_DIR = ROOT_DIR + '\\may-hrv'
@@ -20,7 +15,11 @@ XML_DIRECTORY = DATA_DIR + '\\edfs'
 MSACCESS_DIRECTORY = DATA_DIR + '\\hrv'
 SOMTE_DIRECTORY = DATA_DIR + '\\shhs1-csv'
 
-OUTPUT_FILE = '\\results.csv'
+OUTPUT_FILE = '\\results.csv'      # .csv, or .parquet / .feather for a typed table (needs pyarrow)
+CACHE_DIRECTORY = RESULTS_DIR + '\\cache'   # parsed XML/EDF data is kept here between runs.  Set to None for no cache
+CACHE_MAX_BYTES = 4 * 1024**3               # the least recently used patients are dropped from the cache past this size
+CHECKPOINT_DIRECTORY = None                 # e.g. RESULTS_DIR + '\\checkpoint' to keep each patient's rows and resume
+                                            # an interrupted run.  Clear it after changing the code
 
 DT_CONTROL_WINDOW  = 2.5*60 # seconds - width of control window
 DT_INTERVAL        = 5*60   # seconds - intervals from NSVT onset
@@ -30,140 +29,55 @@ DT_HAZARD_OFFSET   = 0      # seconds - difference between the end of the hazard
 N_CTRL_PERIODS     = 3      # number of control periods to downselect to.  Set to None for no downselect
 MIN_N_CTRL_PERIODS = 1      # minimum number of control periods to consider for inclusion
 
-random.seed(123456)
-
-# setup stuff
-sleep_times = get_sleep_times(RESULTS_DIR + '\\Sleep_period_lights_on_off.csv')
-nsvt_times = get_NSVT_times(RESULTS_DIR + '\\NSVTtimes_allPLMI_clean.csv')
-study_times = get_study_start_time(RESULTS_DIR + '\\NSVTtimes_allPLMI_clean.csv')
-pt_ids = nsvt_times.keys()  # we only need to look at patients with NSVT events
-
-# create an array of Patients
-patients = []
-
-for pt in pt_ids:
-    patients.append(Patient(pt, sleep_times[pt], study_times[pt], nsvt_times[pt], XML_DIRECTORY))
-
-# create output file and write header
-fout = open(RESULTS_DIR + OUTPUT_FILE, 'w')
-fout.writelines("stratum,ID,patient_event_number,segment_event_number,case_control,epoch_number,period_start_time,sleep_stage,PLMS_event,PLMS_type1,PLMS_type2,PLMS_type3,PLMS_type4,PLMS_type5,resp_event,resp_type1,resp_type2,arousal,PLMS_assos,resp_assos,minsat,NSVT_start,NSVT_duration,NSVT_sstage,segment_duration,segment_start,segment_end\n")
-out_format = "{},"*26 + "{}\n"
-
-# Do the actual work here...
-# for each patient
-stratum = 0
-for pt in patients:
-    print pt.id
-    n_nsvt = 0
-
-    # generate approx 30 minute partitions from [sleep onset, lights on]
-    dt_chunk = create_even_chunks(pt.sleep_onset,pt.lights_on)
-
-    # for each NSVT event
-    for nsvt in pt.nsvt_times:
-        ctrl_periods = []
-
-        # ignore any NVST during wake
-        if not pt.is_sleep_time(nsvt):
-            continue
-
-        # find chunk start and chunk end for this NSVT event
-        chunk = chunk_times(nsvt, pt.sleep_onset, pt.lights_on, dt_chunk)
-
-        # build a control window for each  +/-10 minute interval from NSVT offset
-        ctrl_windows = get_control_windows(nsvt, chunk, DT_CONTROL_WINDOW, DT_INTERVAL)
-
-        # divide each window into control periods
-        for window in ctrl_windows:
-            poss_ctl_periods = pt.get_control_periods(window, DT_CONTROL_PERIOD)
-
-            if poss_ctl_periods:
-                # select one of the possible control periods
-                selected = random.sample(poss_ctl_periods, 1)
-                ctrl_periods.append(selected)
-
-        # skip this NSVT event if there are not sufficient number of control periods
-        if len(ctrl_periods) < MIN_N_CTRL_PERIODS:
-            continue
-
-        # downselect number of control periods
-        if N_CTRL_PERIODS is not None:
-            if len(ctrl_periods) >= N_CTRL_PERIODS:
-                ctrl_periods = random.sample(ctrl_periods, N_CTRL_PERIODS)
-            else:
-                continue
-
-        # determine the hazard period for the NSVT
-        hazard_period = pt.get_hazard_period(nsvt, DT_CONTROL_PERIOD, DT_HAZARD_OFFSET)
-
-        # update counters
-        n_nsvt += 1
-        stratum += 1
-
-        # prepare output
-        plms = get_during(pt.plm_events, hazard_period)
-        resp = get_during(pt.resp_events, hazard_period)
-        outline = [out_format.format(stratum,    # stratum
-                                     pt.id,      # pt ID
-                                     n_nsvt,     # NSVT number for this patient
-                                     "?",        # segment event number
-                                     1,          # this is for the HP
-                                     pt.walltime_to_epoch(hazard_period[0]),    # epoch # of start of HP
-                                     hazard_period[0].strftime('%H:%M:%S'),     # start of HP
-                                     pt.get_sleep_stage(nsvt),      # sleep stage at start of NSVT
-                                     1 if any_during(pt.plm_events, hazard_period) else 0,  # PLMS_event
-                                     plms_type(pt, plms, 0),    # PLMS_type1
-                                     plms_type(pt, plms, 1),    # PLMS_type2
-                                     plms_type(pt, plms, 2),    # PLMS_type3
-                                     plms_type(pt, plms, 3),    # PLMS_type4
-                                     plms_type(pt, plms, 4),    # PLMS_type5
-                                     1 if any_during(pt.resp_events, hazard_period) else 0,  # any resp events
-                                     resp_type(pt, resp, 0),       # resp_type1
-                                     resp_type(pt, resp, 1),       # resp_type2
-                                     count_during(pt.arousal_events, hazard_period),    # number of arousals during HP
-                                     count_during(pt.arousal_plm, hazard_period),       # number of arousals associated to PLM during HP
-                                     count_during(pt.arousal_resp, hazard_period),       # resp_assos - number of resp associated arousals
-                                     pt.get_min_O2sat(hazard_period),               # min saturation
-                                     nsvt.strftime('%H:%M:%S'),
-                                     "",      # duration of NSVT, sec
-                                     pt.get_sleep_stage(nsvt),
-                                     (chunk[1] - chunk[0]).seconds / 60.0,
-                                     chunk[0].strftime('%H:%M:%S'),
-                                     chunk[1].strftime('%H:%M:%S')
-                                     )]
-
-        for ctrl in ctrl_periods:
-            ctrl = ctrl[0]
-            plms = get_during(pt.plm_events, ctrl)
-            resp = get_during(pt.resp_events, ctrl)
-            outline.append(out_format.format(stratum,    # stratum
-                                             pt.id,  # pt ID
-                                             n_nsvt,  # NSVT number for this patient
-                                             "?",        # segment event number
-                                             0,  # this is for the control periods
-                                             pt.walltime_to_epoch(ctrl[0]),  # epoch # of start of CP
-                                             ctrl[0].strftime('%H:%M:%S'),  # start of CP
-                                             pt.get_sleep_stage(ctrl[0]),  # sleep stage at start of CP
-                                             1 if any_during(pt.plm_events, ctrl) else 0,
-                                             plms_type(pt, plms, 0),  # PLMS_type1
-                                             plms_type(pt, plms, 1),  # PLMS_type2
-                                             plms_type(pt, plms, 2),  # PLMS_type3
-                                             plms_type(pt, plms, 3),  # PLMS_type4
-                                             plms_type(pt, plms, 4),  # PLMS_type5
-                                             1 if any_during(pt.resp_events, ctrl) else 0,
-                                             resp_type(pt, resp, 0),  # resp_type1
-                                             resp_type(pt, resp, 1),  # resp_type2
-                                             count_during(pt.arousal_events, ctrl),       # number of arousals during CP
-                                             count_during(pt.arousal_plm, ctrl),  # number of arousals associated with PLM during CP
-                                             count_during(pt.arousal_resp, ctrl),  # resp_assos - number of resp associated arousals
-                                             pt.get_min_O2sat(ctrl),  # min saturation
-                                             nsvt.strftime('%H:%M:%S'),
-                                             "",  # duration of NSVT, sec
-                                             pt.get_sleep_stage(nsvt),
-                                             (chunk[1] - chunk[0]).seconds / 60.0,
-                                             chunk[0].strftime('%H:%M:%S'),
-                                             chunk[1].strftime('%H:%M:%S')
-                                             ))
-        fout.writelines(outline)
-
-fout.close()
\ No newline at end of file
+RANDOM_SEED        = 123456   # master seed, each patient gets its own stream derived from this
+N_WORKERS          = None     # number of worker processes.  None to use every core, 1 to run in this process
+N_READ_AHEAD       = 2        # with N_WORKERS = 1, the number of patients loaded ahead of the one being processed
+PREFETCH_DEPTH     = 4        # with N_WORKERS = 1, the number of patients whose files are read ahead.  0 for none
+PREFETCH_MAX_BYTES = 1024**3  # upper bound on the bytes of read ahead files held in memory
+PREFETCH_THREADS   = 4        # number of files read at the same time
+
+CONFIG = Config(DT_CONTROL_WINDOW, DT_INTERVAL, DT_CONTROL_PERIOD, DT_HAZARD_OFFSET, N_CTRL_PERIODS, MIN_N_CTRL_PERIODS)
+
+def make_tasks(configs):
+    """Describe the work for each Patient, they are loaded and processed by the workers
+
+    :param configs: sequence of Config to evaluate for every patient
+    :return: list of Task
+    """
+    sleep_times = get_sleep_times(RESULTS_DIR + '\\Sleep_period_lights_on_off.csv')
+    nsvt_times = get_NSVT_times(RESULTS_DIR + '\\NSVTtimes_allPLMI_clean.csv')
+    study_times = get_study_start_time(RESULTS_DIR + '\\NSVTtimes_allPLMI_clean.csv')
+    pt_ids = nsvt_times.keys()  # we only need to look at patients with NSVT events
+
+    cache = None
+    if CACHE_DIRECTORY is not None:
+        cache = PatientCache(CACHE_DIRECTORY, CACHE_MAX_BYTES)
+
+    seeds = patient_seeds(pt_ids, RANDOM_SEED)
+    return [Task(pt, sleep_times[pt], study_times[pt], nsvt_times[pt], XML_DIRECTORY, seed, tuple(configs), cache)
+            for pt, seed in zip(pt_ids, seeds)]
+
+def make_prefetcher():
+    """The Prefetcher set up by the PREFETCH_* settings, or None"""
+    if PREFETCH_DEPTH > 0:
+        return Prefetcher(PREFETCH_DEPTH, PREFETCH_MAX_BYTES, PREFETCH_THREADS)
+    return None
+
+if __name__ == '__main__':
+    # timers and counters, only if switched on with the INDUCTION_PROFILE environment variable
+    instrument.start()
+
+    tasks = make_tasks([CONFIG])
+
+    # create output file and do the actual work
+    if CHECKPOINT_DIRECTORY is not None:
+        # the output is written from the checkpoint once every patient has been tried, patients that failed are left out
+        checkpoint = Checkpoint(CHECKPOINT_DIRECTORY)
+        update_checkpoint(tasks, checkpoint, N_WORKERS)
+        with open_writer(RESULTS_DIR + OUTPUT_FILE) as writer:
+            assemble(tasks, [writer], checkpoint)
+    else:
+        with open_writer(RESULTS_DIR + OUTPUT_FILE) as writer:
+            run(tasks, [writer], N_WORKERS, N_READ_AHEAD, make_prefetcher())
+
+    instrument.finish()
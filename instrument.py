@@ -0,0 +1,187 @@
+###########################################################
+# instrument.py
+# Optional timers and counters for the stages of a run.
+# Set the environment variable INDUCTION_PROFILE to a
+# directory to switch them on; a JSON summary per patient
+# and for the whole run is written there at the end, and a
+# Chrome trace (chrome://tracing) too if INDUCTION_TRACE=1.
+# When INDUCTION_PROFILE is not set the decorators return
+# the functions untouched, so there is no overhead at all
+###########################################################
+
+import functools
+import glob
+import json
+import os
+import threading
+import time
+
+PROFILE_DIR = os.environ.get('INDUCTION_PROFILE') or None
+ENABLED = PROFILE_DIR is not None
+TRACE = ENABLED and os.environ.get('INDUCTION_TRACE', '0') not in ('', '0')
+
+# each thread records into the profile of the patient it is working on, or into a profile with no patient
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def new_profile(pt_id):
+    return {'pt_id': pt_id, 'pid': os.getpid(), 'stages': {}, 'counters': {}, 'spans': []}
+
+def current():
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        profile = _local.profile = new_profile(None)
+    return profile
+
+def record(name, t0, t1):
+    stages = current()['stages']
+    if name in stages:
+        stages[name][0] += t1 - t0
+        stages[name][1] += 1
+    else:
+        stages[name] = [t1 - t0, 1]
+    if TRACE:
+        current()['spans'].append((name, t0, t1, threading.current_thread().ident))
+
+def timed(name):
+    """Decorator timing every call of a function as the stage name.  Returns the function itself if disabled"""
+    def decorate(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            t0 = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, t0, time.time())
+        return wrapper
+    return decorate
+
+def count(name, n=1):
+    """Add n to the counter name"""
+    if ENABLED:
+        counters = current()['counters']
+        counters[name] = counters.get(name, 0) + n
+
+
+class _Null(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL = _Null()
+
+
+class _Stage(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.name, self.t0, time.time())
+        return False
+
+
+class _Patient(object):
+    def __init__(self, pt_id):
+        self.pt_id = pt_id
+
+    def __enter__(self):
+        self.outer = getattr(_local, 'profile', None)
+        _local.profile = new_profile(self.pt_id)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        save(_local.profile)
+        _local.profile = self.outer
+        return False
+
+def stage(name):
+    """Context manager timing a block as the stage name"""
+    return _Stage(name) if ENABLED else _NULL
+
+def patient(pt_id):
+    """Context manager recording everything timed or counted in the block (by this thread) against patient pt_id"""
+    return _Patient(pt_id) if ENABLED else _NULL
+
+def profile_file():
+    return os.path.join(PROFILE_DIR, 'profile-%d.jsonl' % os.getpid())
+
+def save(profile):
+    # every process appends its profiles to its own file, they are merged by finish
+    with _lock:
+        with open(profile_file(), 'a') as f:
+            f.write(json.dumps(profile) + '\n')
+
+def start():
+    """Clear the profiles of any previous run.  Call from the main process before any work is done"""
+    if not ENABLED:
+        return
+    if not os.path.isdir(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR)
+    for path in glob.glob(os.path.join(PROFILE_DIR, 'profile-*.jsonl')):
+        os.remove(path)
+    _local.profile = new_profile(None)
+
+def load_profiles():
+    profiles = []
+    for path in glob.glob(os.path.join(PROFILE_DIR, 'profile-*.jsonl')):
+        with open(path) as f:
+            profiles.extend(json.loads(line) for line in f)
+    return profiles
+
+def merge(into, profile):
+    for name, (seconds, calls) in profile['stages'].iteritems():
+        stage = into['stages'].setdefault(name, {'seconds': 0.0, 'calls': 0})
+        stage['seconds'] += seconds
+        stage['calls'] += calls
+    for name, n in profile['counters'].iteritems():
+        into['counters'][name] = into['counters'].get(name, 0) + n
+
+def finish():
+    """Merge the profiles written by every process (and thread) into summary.json, and trace.json if tracing.
+    Call from the main process once the work is done.  Returns the summary, None if disabled"""
+    if not ENABLED:
+        return None
+    if getattr(_local, 'profile', None) is not None:
+        save(_local.profile)
+        _local.profile = None
+
+    profiles = load_profiles()
+    patients = {}
+    total = {'stages': {}, 'counters': {}}
+    for profile in profiles:
+        # a patient may have been worked on by more than one thread, e.g. loaded ahead and then processed
+        if profile['pt_id'] is not None:
+            merge(patients.setdefault(profile['pt_id'], {'stages': {}, 'counters': {}}), profile)
+        merge(total, profile)
+
+    for name, stage in total['stages'].iteritems():
+        stage['mean'] = stage['seconds'] / stage['calls']
+    summary = {'n_patients': len(patients), 'total': total, 'patients': patients}
+    with open(os.path.join(PROFILE_DIR, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+
+    if TRACE:
+        write_trace(profiles, os.path.join(PROFILE_DIR, 'trace.json'))
+    return summary
+
+def write_trace(profiles, path):
+    """Write the spans of every profile in the Chrome trace event format"""
+    t_min = min([span[1] for profile in profiles for span in profile['spans']] or [0])
+    events = []
+    for profile in profiles:
+        for name, t0, t1, tid in profile['spans']:
+            events.append({'name': name, 'ph': 'X', 'pid': profile['pid'], 'tid': tid,
+                           'ts': (t0 - t_min) * 1e6, 'dur': (t1 - t0) * 1e6,
+                           'args': {'pt_id': profile['pt_id']}})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
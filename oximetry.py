@@ -0,0 +1,57 @@
+###########################################################
+# oximetry.py
+# Find oxygen desaturation events in the SaO2 signal (drops
+# of some percent below a rolling baseline) as EventTables,
+# and the oxygen desaturation index (ODI)
+###########################################################
+
+import numpy as np
+
+from events import EventTable
+from signals import RangeMin
+
+BASELINE_WINDOW = 120.0     # seconds of SaO2 before a sample that its baseline is the maximum of
+MIN_DURATION = 10.0         # seconds a drop must last to count as a desaturation
+
+
+def rolling_max(values, width, valid=None):
+    """Maximum of the valid values[i - width:i] for every i, -inf where there is none.
+    Answered for all samples at once by range queries on a RangeMin of the negated values"""
+    values = np.asarray(values, dtype=np.float64)
+    i1 = np.arange(values.size)
+    return -RangeMin(-values, valid).min_batch(np.maximum(i1 - width, 0), i1)
+
+def runs(mask):
+    """Start and end (exclusive) indices of the runs of True in a boolean array"""
+    edges = np.diff(np.concatenate(([False], mask, [False])).astype(np.int8))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def find_desaturations(signal, drop, valid=None, baseline_window=BASELINE_WINDOW, min_duration=MIN_DURATION):
+    """Desaturations: runs of valid samples at least drop (percent SaO2) below the baseline, the highest valid sample
+    of the baseline_window seconds before each, that last at least min_duration seconds.
+
+    :param signal: signals.Signal of SaO2, its origin being the start of the study
+    :param drop: fall from the baseline, in percent SaO2, e.g. 3 or 4
+    :param valid: optional boolean array, one per sample, False for artifacts
+    :return: EventTable of seconds since the start of the study; the code of each event is its deepest fall below
+             the baseline, in whole percent
+    """
+    values = signal.values
+    if valid is None:
+        valid = np.ones(values.shape, dtype=bool)
+    fall = rolling_max(values, int(round(baseline_window * signal.sample_rate)), valid) - values
+
+    below = valid & (fall >= drop)      # -inf baselines (no valid samples before) are never below
+    starts, ends = runs(below)
+    long_enough = (ends - starts) >= min_duration * signal.sample_rate
+    starts, ends = starts[long_enough], ends[long_enough]
+
+    # deepest fall of each run, reducing over [start, end) pairs (the padding makes an end at the last sample valid)
+    bounds = np.column_stack((starts, ends)).ravel()
+    depth = np.maximum.reduceat(np.append(fall, -np.inf), bounds)[::2] if starts.size else np.empty(0)
+    return EventTable(signal.origin, starts / signal.sample_rate, ends / signal.sample_rate,
+                      np.floor(depth).astype(np.int32))
+
+def odi(events, hours):
+    """Oxygen desaturation index: desaturations per hour, NaN if hours is 0"""
+    return len(events) / hours if hours > 0 else float('nan')
@@ -1,8 +1,25 @@
 import datetime
-import re
+import math
+import os
+from cStringIO import StringIO
 
-from helper import get_sleep_stages, make_after, plm_from_xml, simple_event_from_xml, is_associated, plm_arousal_associated, remove_close_events
+import numpy as np
+
+from association import associated_pairs, expand_ranges, plm_arousal_mask
+from helper import read_annotations, make_after, remove_close_events, round_us, RESP_CODES, PLM_CODES
 from edf import EDF
+from events import EventTable
+from signals import Signal, RangeMin, valid_range
+from instrument import timed, count
+from plm import find_plm_series, merge_bilateral
+from hrv import RRSeries, detect_r_peaks
+from oximetry import find_desaturations, odi
+
+
+def input_files(id, xml_path):
+    """Paths of the XML and EDF files a patient is read from"""
+    return [os.path.join(xml_path, id.lower() + '.edf.XML'), os.path.join(xml_path, id.lower() + '.edf')]
+
 
 class Patient:
     id = ""
@@ -11,35 +28,87 @@ class Patient:
     start_time = None
     nsvt_times = None
 
-    plm_events = None       # list of tuples of datetimes
-    arousal_events = None   # list of tuples of datetimes
-    resp_events = None      # dictionary of list of tuples of datetimes
+    plm_events = None       # EventTable, codes say whether the PLM is associated with an arousal (see PLM_CODES)
+    plm_series = None       # periodic series number of each PLM in plm_events, -1 if it is in none
+    arousal_events = None   # EventTable
+    resp_events = None      # EventTable, codes are the type of event (see RESP_CODES)
+
+    plma_events = None      # EventTable of PLMs associated with Arousals
+    plm_resp_events = None  # EventTable of PLMs associated with Resp. Events, codes are the type of Resp. Event
+
+    arousal_resp = None     # EventTable of Arousals associated with Resp Events
+    arousal_plm = None      # EventTable of Arousals associated with PLM Events
 
-    plma_events = None      # list of PLMs associated with Arousals
-    plm_resp_events = None  # list of PLMs associated with Resp. Events
+    o2_sat = None           # oxygen saturation - Signal from EDF file
+    o2_min = None           # RangeMin over o2_sat, artifacts masked
+    desat3_events = None    # EventTable of falls of 3% or more in o2_sat, codes are the deepest fall in %
+    desat4_events = None    # EventTable of falls of 4% or more in o2_sat, codes are the deepest fall in %
+    edf_file = None         # path of the EDF file
+    rr_series = None        # hrv.RRSeries of the ECG, detected the first time get_hrv is called
 
-    arousal_resp = None     # list of Arousals associated with Resp Events
-    arousal_plm = None      # list of Arousals associated with PLM Events
+    O2_SAT_MIN_VALID = 20.0 # O2 saturation at or below this is an artifact
 
-    o2_sat = None           # oxygen saturation - from EDF file
+    # (lo, hi) bounds of the valid samples of EDF channels (by lower case name), used by get_channel_stats to mask
+    # artifacts.  Either bound may be None
+    CHANNEL_VALID_RANGES = {'sao2': (O2_SAT_MIN_VALID, None)}
 
-    def __init__(self, id, study_times, start_time, nsvt_times, xml_path):
+    # the EventTable attributes, in the order they are derived
+    EVENT_TABLES = ('plm_events', 'arousal_events', 'resp_events',
+                    'plma_events', 'plm_resp_events', 'arousal_resp', 'arousal_plm')
+
+    @timed('patient.__init__')
+    def __init__(self, id, study_times, start_time, nsvt_times, xml_path, cache=None, files=None):
         self.id = id
-        self.start_time = start_time
-        self.sleep_onset = make_after(self.start_time, study_times['sleep_onset'])
-        self.lights_on = make_after(self.sleep_onset, study_times['lights_on'])
-        self.nsvt_times = remove_close_events(nsvt_times, 5*60)
+        self.start_time = start_time    # datetime, every other time is held as seconds since the start of the study
+
+        # the study times are clock times, place each of them after the one before
+        self.sleep_onset = make_after(0, self.to_seconds(study_times['sleep_onset']))
+        self.lights_on = make_after(self.sleep_onset, self.to_seconds(study_times['lights_on']))
+        self.nsvt_times = remove_close_events([self.to_seconds(t) for t in nsvt_times], 5*60)
 
-        # extract the sleeping stages (based on epoch) from the XML file for the patient
+        # everything else comes from the XML and EDF files, or from the cache if they have been read before
         fname = self.id.lower() + '.edf.XML'
-        self.sleep_list = get_sleep_stages(xml_path, fname)
+        self.edf_file = input_files(self.id, xml_path)[1]
+        if cache is not None:
+            key = cache.key(input_files(self.id, xml_path))
+            arrays = cache.load(key)
+            if arrays is not None:
+                try:
+                    self.from_arrays(arrays)
+                    return
+                except KeyError:
+                    # the entry is missing some of the arrays, read the files again
+                    cache.discard(key)
+
+        self.load(xml_path, fname, files)
+
+        if cache is not None:
+            cache.save(key, self.to_arrays())
+
+    @timed('patient.load')
+    def load(self, xml_path, fname, files=None):
+        # files is an optional dictionary of the bytes of the input files keyed by path, for files that have already
+        # been read (see prefetch.py).  Anything not in it is read from disk
+        files = files or {}
+
+        # read all of the annotations from the XML file for the patient in one pass
+        xml = files.get(os.path.join(xml_path, fname))
+        annotations = read_annotations(xml_path, fname, None if xml is None else StringIO(xml))
+
+        # extract the sleeping stages (based on epoch)
+        self.set_sleep_stages(annotations['sleep_stages'])
 
         # get the PLM event data
-        self.plm_events = self.get_plm(xml_path, fname)
+        self.plm_events = self.get_plm(annotations['plm'])
+        self.plm_series = find_plm_series(self.plm_events.starts)
 
         # get the arousal events
-        self.arousal_events = self.get_arousals(xml_path, fname)
-        self.resp_events = self.get_respiratory_events(xml_path, fname)
+        self.arousal_events = self.get_arousals(annotations['arousal'])
+        self.resp_events = self.get_respiratory_events(annotations['resp'])
+
+        count('events.plm', len(self.plm_events))
+        count('events.arousal', len(self.arousal_events))
+        count('events.resp', len(self.resp_events))
 
         # find associations with other events
         self.plma_events, self.plm_resp_events = self.find_plm_associations()
@@ -47,238 +116,254 @@ class Patient:
         self.arousal_plm = self.find_arousal_plm_assoc()
 
         # extract the O2 saturation from the EDF file
-        self.o2_sat = self.extract_O2_sat(xml_path, self.id.lower())
+        self.o2_sat = self.extract_O2_sat(xml_path, self.id.lower(), files)
+        self.desat3_events, self.desat4_events = self.find_desaturations()
+
+    def to_arrays(self):
+        """Dictionary of NumPy arrays holding everything derived from the XML and EDF files"""
+        arrays = {'sleep_list': np.array(self.sleep_list, dtype=np.int32)}
+        for name in self.EVENT_TABLES:
+            arrays.update(getattr(self, name).to_arrays(name))
+        if self.o2_sat is not None:
+            arrays['o2_sat'] = self.o2_sat.values
+            arrays['o2_sample_rate'] = np.array(self.o2_sat.sample_rate)
+        return arrays
+
+    def from_arrays(self, arrays):
+        """Restore everything derived from the XML and EDF files from the output of to_arrays"""
+        self.set_sleep_stages(arrays['sleep_list'].tolist())
+        for name in self.EVENT_TABLES:
+            setattr(self, name, EventTable.from_arrays(self.start_time, arrays, name))
+        self.plm_series = find_plm_series(self.plm_events.starts)
+        if 'o2_sat' in arrays:
+            self.o2_sat = Signal(self.start_time, arrays['o2_sat'], float(arrays['o2_sample_rate']))
+            self.o2_min = RangeMin(self.o2_sat.values, valid=self.o2_sat.values > self.O2_SAT_MIN_VALID)
+        self.desat3_events, self.desat4_events = self.find_desaturations()
+
+    def to_seconds(self, time):
+        """Convert a datetime to seconds since the start of the study"""
+        return (time - self.start_time).total_seconds()
+
+    def to_walltime(self, time):
+        """Convert seconds since the start of the study to a datetime"""
+        return self.start_time + datetime.timedelta(seconds=time)
+
+    def time_to_epoch(self, time):
+        # epoch 1 starts at time=0 and is 30 seconds long
+        return int(math.floor(time / 30.0)) + 1
+
+    def epoch_to_time(self, epoch):
+        ts = (epoch - 1) * 30.0
+        return (ts, ts + 30.0)
 
     def walltime_to_epoch(self, time):
-        dt = time - self.start_time
-
-        # epoch 1 starts at dt=0 and is 30 seconds long
-        return int(dt.seconds / 30.0) + 1
+        return self.time_to_epoch(self.to_seconds(time))
 
     def epoch_to_walltime(self, epoch):
-        ts = self.start_time + datetime.timedelta(seconds=((epoch - 1) * 30.0))
-        return (ts, ts + datetime.timedelta(seconds=30))
+        ts, tf = self.epoch_to_time(epoch)
+        return (self.to_walltime(ts), self.to_walltime(tf))
 
     def is_sleep_time(self, time):
-        epoch = self.walltime_to_epoch(time)
+        epoch = self.time_to_epoch(time)
         return self.is_sleep_epoch(epoch)
 
+    @timed('patient.set_sleep_stages')
+    def set_sleep_stages(self, sleep_list):
+        """Store the hypnogram and index it: a per-epoch sleep mask and the bouts of sleep it is made of"""
+        self.sleep_list = sleep_list
+        self.sleep_mask = np.array(sleep_list, dtype=np.int32) != 0
+
+        # run-length encode the mask.  Bout i is epochs sleep_bouts[0][i] up to (not including) sleep_bouts[1][i]
+        edges = np.diff(np.concatenate(([False], self.sleep_mask, [False])).astype(np.int8))
+        self.sleep_bouts = (np.flatnonzero(edges == 1) + 1, np.flatnonzero(edges == -1) + 1)
+
     def is_sleep_epoch(self, epoch):
-        if self.sleep_list[epoch-1] == 0:
+        # there is no sleep outside of the scored epochs
+        if epoch < 1 or epoch > self.sleep_mask.size:
             return False
-        else:
-            return True
+        return bool(self.sleep_mask[epoch-1])
 
     def get_sleep_stage(self, when):
+        """Sleep stage at when, either a datetime or seconds since the start of the study"""
         if isinstance(when, datetime.datetime):
             epoch = self.walltime_to_epoch(when)
         else:
-            epoch = when
+            epoch = self.time_to_epoch(when)
         return self.sleep_list[epoch - 1]
 
     def get_control_periods(self, ctrl_window, ctrl_period_width):
-        # find intervals of sleep that are at least ctrl_period_width
-
-        # Find the intervals of sleep during the ctrl_window...
-        sleep_times = []
-        sleep_time = [0, 0]
-
-        epoch = self.walltime_to_epoch(ctrl_window[0])
-        if self.is_sleep_epoch(epoch):
-            sleep_time[0] = ctrl_window[0]
-
-        # this will list all epochs interior to the ctrl_window. Need to manually handle the edges
-        epochs = range(self.walltime_to_epoch(ctrl_window[0])+1, self.walltime_to_epoch(ctrl_window[1])+1)
-        for epoch in epochs:
-            if self.is_sleep_epoch(epoch):
-                if sleep_time[0] == 0:
-                    sleep_time[0] = self.epoch_to_walltime(epoch)[0]
-            else:
-                if sleep_time[0] != 0:
-                    sleep_time[1] = self.epoch_to_walltime(epoch)[0]
-                    sleep_times.append((sleep_time[0], sleep_time[1]))
-                    sleep_time = [0, 0]
-
-        # handle the last epoch which might run past the edge of the window
-        if sleep_time[0] !=0 and sleep_time[1] == 0:
-            sleep_times.append((sleep_time[0], ctrl_window[1]))
-
-        if not sleep_times:
-            return None
-
-        # Go through each sleep_time to see which are candidate control periods
-        ctl_periods = []
-        ctrl_period_width = datetime.timedelta(seconds=ctrl_period_width)
-        for sleep_time in sleep_times:
-            n_ctrl_periods = int((sleep_time[1] - sleep_time[0]).seconds / ctrl_period_width.seconds)
-            for i in range(0,n_ctrl_periods):
-                ts = sleep_time[0] + i * ctrl_period_width
-                tf = ts + ctrl_period_width
-                ctl_periods.append((ts, tf))
+        """Find the candidate control periods in a single control window, see get_control_periods_batch"""
+        return self.get_control_periods_batch([ctrl_window], ctrl_period_width)[0]
+
+    @timed('patient.get_control_periods_batch')
+    def get_control_periods_batch(self, ctrl_windows, ctrl_period_width):
+        """Find the candidate control periods in each of several control windows
 
+        Each bout of sleep that overlaps a window is clipped to the window, and cut into as many back to back periods
+        of ctrl_period_width as fit from its start.  The bouts come from the run-length encoded hypnogram, so there is
+        no per-epoch work.
+
+        :param ctrl_windows: sequence of tuples of times (seconds since start of study)
+        :param ctrl_period_width: number of seconds
+        :return: list, one per window, of lists of tuples of times
+        """
+        windows = np.array(ctrl_windows, dtype=np.float64).reshape(-1, 2)
+        bout_starts, bout_ends = self.sleep_bouts
+
+        # the bouts that share an epoch with each window
+        first_epoch = np.floor(windows[:, 0] / 30.0) + 1
+        last_epoch = np.floor(windows[:, 1] / 30.0) + 1
+        lo = np.searchsorted(bout_ends, first_epoch, side='right')
+        hi = np.searchsorted(bout_starts, last_epoch, side='right')
+        w, b = expand_ranges(lo, hi)
+
+        # clip the bouts to their window and count how many periods fit in each
+        starts = np.maximum((bout_starts[b] - 1) * 30.0, windows[w, 0])
+        ends = np.minimum((bout_ends[b] - 1) * 30.0, windows[w, 1])
+        n_periods = np.maximum(np.floor_divide(np.round(ends - starts, 6), ctrl_period_width), 0).astype(np.intp)
+
+        bout, i = expand_ranges(np.zeros(n_periods.size, dtype=np.intp), n_periods)
+        ts = np.round(starts[bout] + i * ctrl_period_width, 6)
+        tf = np.round(ts + ctrl_period_width, 6)
+
+        # split the periods up by window, they are already in order
+        ctl_periods = [[] for window in windows]
+        for k, period in zip(w[bout].tolist(), zip(ts.tolist(), tf.tolist())):
+            ctl_periods[k].append(period)
         return ctl_periods
 
     def get_hazard_period(self, nsvt_time, ctrl_period_width, nsvt_offset):
         """Compute the hazard period for a given NSVT event
 
-        :param nsvt_time: datetime of the NSVT event
+        :param nsvt_time: time of the NSVT event, seconds since the start of the study
         :param ctrl_period_width: integer number of seconds
         :param nsvt_offset: integer number of seconds
-        :return: tuple of datetimes
+        :return: tuple of times, seconds since the start of the study
         """
-        ctrl_period_width = datetime.timedelta(seconds=ctrl_period_width)
-        nsvt_offset = datetime.timedelta(seconds=nsvt_offset)
-
-        te = nsvt_time - nsvt_offset
-        hazard_period = (te - ctrl_period_width, te)
+        te = round_us(nsvt_time - nsvt_offset)
+        hazard_period = (round_us(te - ctrl_period_width), te)
         return hazard_period
 
-    def get_plm(self, xml_path, fname):
+    @timed('patient.get_plm')
+    def get_plm(self, plms):
         """Find all PLM events that occur for this patient
         PLM is denoted in the .XML file by <ScoredEvent> with <Name> = PLM (Right or Left)
 
-        If the Right and Left start within 5 sec (< 5) then they are counted as a single event.
+        PLMs that start while awake are dropped.  If the Right and Left start less than 0.5 sec apart then they are
+        counted as a single event, see plm.merge_bilateral.
 
-        :param xml_path: path to the XML files
-        :param fname: name of the .XML file for this patient
-        :return:
+        :param plms: structured array of plm.PLM_DTYPE read from the XML file, times in seconds since start of recording
+        :return: EventTable of the PLM events
         """
-        re_se = re.compile(ur'(<ScoredEvent><Name>PLM.+?<\/ScoredEvent>)')
-
-        plm_events = []
-        with open(xml_path + '\\' + fname, 'r') as f:
-            data = f.read()
-            for se in re.finditer(re_se, data):
-                event = plm_from_xml(se.group(0))  # event is of class Plm
-
-                event.tstart = self.start_time + datetime.timedelta(seconds=event.tstart)
-                event.tend = self.start_time + datetime.timedelta(seconds=event.tend)
-
-                # skip if awake at start of PLM event
-                if not self.is_sleep_time(event.tstart):
-                    continue
-
-                # determine if this event is associated with the last event
-                if len(plm_events) > 0:
-                    if event.is_associated(plm_events[-1], 0.5):
-                        # if it is, then extend the tend of the prev event and ignore the new event
-                        plm_events[-1].tend = max(event.tend, plm_events[-1].tend)
-                        plm_events[-1].side = event.side
-                        continue
-
-                plm_events.append(event)
+        # the same test as is_sleep_time, on every PLM at once
+        epochs = np.floor(plms['tstart'] / 30.0).astype(np.intp)
+        asleep = (epochs >= 0) & (epochs < self.sleep_mask.size)
+        asleep[asleep] = self.sleep_mask[epochs[asleep]]
 
-        # Convert all PLM events in plm_events to windows of clock time
-        plm_periods = []
-        for event in plm_events:
-            plm_periods.append((event.tstart, event.tend))
+        starts, ends = merge_bilateral(plms[asleep])
+        return EventTable(self.start_time, starts, ends)
 
-        return plm_periods
+    def get_plms_index(self):
+        """PLMS index: the PLMs that are part of a periodic series (see plm.find_plm_series) per hour of sleep, for
+        the whole of sleep and for each sleep stage of the hypnogram.  A PLM counts towards the stage of the epoch it
+        starts in.
 
-    def get_arousals(self, xml_path, fname):
-        re_se = re.compile(ur'(<ScoredEvent><Name>Arousal.+?<\/ScoredEvent>)')
-
-        events = []
-        with open(xml_path + '\\' + fname, 'r') as f:
-            data = f.read()
-            for se in re.finditer(re_se, data):
-                event = simple_event_from_xml(se.group(0))  # event is a tuple (tstart, tend) in seconds since start of recording
-
-                ts = self.start_time + datetime.timedelta(seconds=event[0])
-                te = self.start_time + datetime.timedelta(seconds=event[1])
-
-                events.append((ts, te))
-
-        return events
-
-    def get_respiratory_events(self, xml_path, fname):
+        :return: dictionary of PLMS per hour keyed by stage number, and by 'sleep' for all of the sleep stages
+        """
+        stages = np.asarray(self.sleep_list, dtype=np.intp)
+        epochs = np.floor(self.plm_events.starts / 30.0).astype(np.intp)
+        in_series = (self.plm_series >= 0) & (epochs >= 0) & (epochs < stages.size)
+
+        n_plms = np.bincount(stages[epochs[in_series]], minlength=stages.max() + 1 if stages.size else 0)
+        n_epochs = np.bincount(stages, minlength=n_plms.size)
+        index = dict((stage, n_plms[stage] / (n_epochs[stage] * 30 / 3600.0))
+                     for stage in np.flatnonzero(n_epochs).tolist() if stage != 0)
+        sleep_hours = self.sleep_mask.sum() * 30 / 3600.0
+        index['sleep'] = n_plms[1:].sum() / sleep_hours if sleep_hours else float('nan')
+        return index
+
+    @timed('patient.get_arousals')
+    def get_arousals(self, arousals):
+        # each event is a tuple (tstart, tend) in seconds since start of recording
+        return EventTable(self.start_time, [e[0] for e in arousals], [e[1] for e in arousals])
+
+    @timed('patient.get_respiratory_events')
+    def get_respiratory_events(self, resp):
         # Central Apnea, Mixed Apena, Obstructive Apnea
         # Obstructive Hypopnea, Central Hypopnea, Mixed Hypopnea, Hypopnea
-        events = {}
-        map = {'ca': "Central Apnea",
-               'ma': "Mixed Apnea",
-               'oa': "Obstructive Apnea",
-               'h':  "(Central |Mixed |Obstructive)*Hypopnea"
-               }
+        tables = []
+        for k, v in resp.iteritems():
+            # each event is a tuple (tstart, tend) in seconds since start of recording
+            tables.append(EventTable(self.start_time, [e[0] for e in v], [e[1] for e in v], [RESP_CODES[k]] * len(v)))
+        return EventTable.concat(self.start_time, tables)
 
-        for k, v in map.iteritems():
-            events[k] = []
-            pattern = "<ScoredEvent><Name>" + v + ".+?<\/ScoredEvent>"
-
-            re_se = re.compile(pattern)
-
-            with open(xml_path + '\\' + fname, 'r') as f:
-                data = f.read()
-                for se in re.finditer(re_se, data):
-                    event = simple_event_from_xml(se.group(0))  # event is a tuple (tstart, tend) in seconds since start of recording
-
-                    # convert the event to wall time
-                    ts = self.start_time + datetime.timedelta(seconds=event[0])
-                    te = self.start_time + datetime.timedelta(seconds=event[1])
+    @timed('patient.find_plm_associations')
+    def find_plm_associations(self):
+        # plm associated with arousals, a PLM is listed once for every arousal it is associated with
+        i, j = associated_pairs(self.plm_events, self.arousal_events)
+        plma = self.plm_events.subset(i)
 
-                    events[k].append((ts, te))
-        return events
+        # label each PLM by whether it has any associated arousal
+        associated = np.zeros(len(self.plm_events), dtype=bool)
+        associated[i] = True
+        self.plm_events.codes = np.where(associated, PLM_CODES['plma'], PLM_CODES['plm']).astype(np.int32)
+        plma.codes = self.plm_events.codes[i]
 
-    def find_plm_associations(self):
-        plma = [] # plm associated with arousals
-        for plm in self.plm_events:
-            for arousal in self.arousal_events:
-                if is_associated(plm, arousal):
-                    plma.append(plm)
-
-        plm_resp = {} # plm associated with respiratory events
-        for k in self.resp_events.keys():
-            plm_resp[k] = []
-            for event in self.resp_events[k]:
-                for plm in self.plm_events:
-                    if is_associated(event, plm, constraint=(-0.5, 0.5), fixedOrder=True):
-                        plm_resp[k].append(plm)
-                        continue  # there can be only 1 PLM associated with a given event
+        # plm associated with respiratory events, tagged with the type of the respiratory event
+        i, j = associated_pairs(self.resp_events, self.plm_events, constraint=(-0.5, 0.5), fixedOrder=True)
+        plm_resp = self.plm_events.subset(j)
+        plm_resp.codes = self.resp_events.codes[i]
 
         return plma, plm_resp
 
+    @timed('patient.find_arousal_association')
     def find_arousal_association(self):
-        # We don't care what kind of resp events...so squish them
-        a = []
-        for k, v in self.resp_events.iteritems():
-            for event in v:
-                a.append(event)
-        resp_events = a
-
-        arousal_resp = [] # arousals associated with Resp events
-        for arousal in self.arousal_events:
-            for resp in resp_events:
-                if is_associated(resp, arousal, constraint=(-3.0, 3.0), fixedOrder=True):
-                    arousal_resp.append(arousal)
-                    continue # there can be only 1 Resp Event associated with an arousal
-        return arousal_resp
+        # We don't care what kind of resp events...they are all in the one table
+        # arousals associated with Resp events, listed once per associated Resp event
+        i, j = associated_pairs(self.resp_events, self.arousal_events, constraint=(-3.0, 3.0), fixedOrder=True)
+        return self.arousal_events.subset(np.sort(j))
 
+    @timed('patient.find_arousal_plm_assoc')
     def find_arousal_plm_assoc(self):
-        arousal_plm = [] # arousals associated with plm events
-        for arousal in self.arousal_events:
-            for plm in self.plm_events:
-                if plm_arousal_associated(plm, arousal, constraint=(-0.5, 0.5)):
-                    arousal_plm.append(arousal)
-                    break # there can be only 1 PLM Event associated with an arousal
-        return arousal_plm
-
-    def extract_O2_sat(self, edf_path, fname):
-        a = EDF(edf_path + '\\' + fname + '.edf')
-        if 'sao2' not in a.channels:
-            print "sao2 channel not found in %s.edf" % fname
-            return None
-
-        o2 = a.channel_to_tuples('sao2', self.start_time)    # o2 is a list of tuples (t, value)
+        # arousals associated with plm events, there can be only 1 PLM Event associated with an arousal
+        return self.arousal_events.subset(plm_arousal_mask(self.plm_events, self.arousal_events, constraint=(-0.5, 0.5)))
+
+    @timed('patient.extract_O2_sat')
+    def extract_O2_sat(self, edf_path, fname, files=None):
+        # only the header and the sao2 samples are read, the file is closed as soon as we are done with it
+        path = os.path.join(edf_path, fname + '.edf')
+        data = (files or {}).get(path)
+        with (EDF(path) if data is None else EDF(data=data)) as a:
+            if 'sao2' not in a.channels:
+                print "sao2 channel not found in %s.edf" % fname
+                return None
+
+            c = a.extractChannel('sao2')
+        o2 = Signal(self.start_time, c['signal'], c['sample_rate'])
+
+        # for some reason getting values = 0.005 and lower... so ignore anything that low when looking for the minimum
+        self.o2_min = RangeMin(o2.values, valid=o2.values > self.O2_SAT_MIN_VALID)
 
         return o2
 
-    def get_min_O2sat(self, period):
-        min_sat = float('inf')
+    @timed('patient.find_desaturations')
+    def find_desaturations(self):
+        # desaturations are quick to find again, so they are not kept in the cache
+        if self.o2_sat is None:
+            return EventTable(self.start_time), EventTable(self.start_time)
+        valid = self.o2_sat.values > self.O2_SAT_MIN_VALID
+        return find_desaturations(self.o2_sat, 3, valid), find_desaturations(self.o2_sat, 4, valid)
+
+    def get_odi(self, drop=3):
+        """Oxygen desaturation index: desaturations of drop (3 or 4) percent that start during sleep, per hour of sleep"""
+        events = {3: self.desat3_events, 4: self.desat4_events}[drop]
+        epochs = np.floor(events.starts / 30.0).astype(np.intp)
+        in_sleep = self.sleep_mask[np.minimum(epochs, self.sleep_mask.size - 1)] & (epochs < self.sleep_mask.size)
+        return odi(events.subset(in_sleep), self.sleep_mask.sum() * 30 / 3600.0)
 
-        for t in self.o2_sat:
-            if t[0] >= period[0] and t[0] < period[1]:
-                if t[1] < min_sat and t[1] > 20.0:      # for some reason getting values = 0.005 and lower...
-                    min_sat = t[1]
+    def get_min_O2sat(self, period):
+        i0, i1 = self.o2_sat.index_bounds(period)
+        min_sat = self.o2_min.min(i0, i1)
 
         # there are sometimes data dropout which will cause the output == inf but R does not like that
         # simply return an empty string instead
@@ -286,3 +371,49 @@ class Patient:
             return ""
 
         return min_sat
+
+    def get_channel_stats(self, channels, periods, stats, valid_ranges=None):
+        """Summarize EDF channels over a batch of periods, see EDF.channel_stats and signals.Signal.window_stats.
+        Each channel is read once for the whole batch.  sao2 is taken from the copy the patient already holds (which
+        may come from the cache) rather than read again.
+
+        :param channels: list of channel names, case insensitive
+        :param periods: sequence of tuples of times (seconds since start of study), or an array of shape (n, 2)
+        :param stats: list of statistic names, e.g. ['min', 'max', 'mean', 'p90', 'masked_mean']
+        :param valid_ranges: dictionary of (lo, hi) bounds of the valid samples by lower case channel name, for the
+                             masked_ statistics.  Defaults to CHANNEL_VALID_RANGES
+        :return: dictionary of arrays of shape (n, len(stats)) by channel name, NaN where there are no samples
+        """
+        if valid_ranges is None:
+            valid_ranges = self.CHANNEL_VALID_RANGES
+        periods = np.asarray(periods, dtype=np.float64).reshape(-1, 2)
+
+        result = {}
+        from_edf = []
+        for name in channels:
+            if name.lower() == 'sao2' and self.o2_sat is not None:
+                bounds = valid_ranges.get('sao2')
+                valid = None if bounds is None else valid_range(self.o2_sat.values, bounds)
+                result[name] = self.o2_sat.window_stats(periods, stats, valid)
+            else:
+                from_edf.append(name)
+
+        if from_edf:
+            # the recording starts at the start of the study, so the periods are also seconds since its start
+            with EDF(self.edf_file) as a:
+                result.update(a.channel_stats(from_edf, periods, stats, valid_ranges))
+        return result
+
+    def get_hrv(self, periods, channel='ecg'):
+        """Time-domain HRV (mean RR, SDNN, RMSSD) over a batch of periods, see hrv.RRSeries.hrv.
+        The R peaks are detected on the first call by streaming the ECG channel of the EDF file, and kept.
+
+        :param periods: sequence of tuples of times (seconds since start of study), or an array of shape (n, 2)
+        :param channel: name of the ECG channel, case insensitive
+        :return: dictionary of arrays of length n by statistic, see hrv.RRSeries.hrv
+        """
+        if self.rr_series is None:
+            # the recording starts at the start of the study, so the beat times are also seconds since its start
+            with EDF(self.edf_file) as a:
+                self.rr_series = RRSeries(detect_r_peaks(a, channel))
+        return self.rr_series.hrv(periods)
@@ -0,0 +1,379 @@
+###########################################################
+# pipeline.py
+# The case-crossover work for a single patient, and a driver
+# that runs it over the whole cohort on a pool of processes,
+# for one or several configurations of the design at once
+###########################################################
+
+import collections
+import itertools
+import multiprocessing
+import Queue
+import random
+import sys
+import threading
+import traceback
+
+import instrument
+from features import compute_period_features
+from instrument import timed, count
+from patient import Patient
+from helper import create_even_chunks, \
+    chunk_times, \
+    get_control_windows,\
+    round_us
+
+# the parameters of the case-crossover design, see induction.py
+Config = collections.namedtuple('Config', ['control_window',      # seconds - width of control window
+                                           'interval',            # seconds - intervals from NSVT onset
+                                           'control_period',      # seconds - width of the control periods
+                                           'hazard_offset',       # seconds - end of the hazard period to the NSVT
+                                           'n_ctrl_periods',      # number of control periods to downselect to
+                                           'min_n_ctrl_periods'   # minimum number of control periods to include
+                                           ])
+
+IN_FLIGHT_PER_WORKER = 2    # patients handed to the pool ahead of the one whose results are being written, per worker
+
+# everything a worker needs to load and process one patient, configs is a sequence of Config to evaluate
+Task = collections.namedtuple('Task', ['pt_id', 'study_times', 'start_time', 'nsvt_times', 'xml_path', 'seed',
+                                       'configs', 'cache'])
+
+
+def patient_seeds(pt_ids, seed):
+    """Derive one RNG seed per patient from the master seed.
+    The seeds are drawn in the order of pt_ids, so a patient's stream of random numbers does not depend on which
+    worker processes it or when."""
+    master = random.Random(seed)
+    return [master.getrandbits(64) for pt_id in pt_ids]
+
+@timed('pipeline.patient_strata')
+def patient_strata(pt, config, rng):
+    """Build the output rows for every usable NSVT event of a patient.
+
+    :param pt: Patient
+    :param config: Config of the case-crossover design
+    :param rng: random.Random used to select the control periods
+    :return: list of strata, each a list of output rows (tuples of values, see writer.COLUMNS) without the leading
+             stratum column, which is only known once the rows of every patient are merged
+    """
+    selected_events = []
+
+    # generate approx 30 minute partitions from [sleep onset, lights on]
+    dt_chunk = create_even_chunks(pt.sleep_onset,pt.lights_on)
+
+    # for each NSVT event
+    for nsvt in pt.nsvt_times:
+        ctrl_periods = []
+
+        # ignore any NVST during wake
+        if not pt.is_sleep_time(nsvt):
+            continue
+
+        # find chunk start and chunk end for this NSVT event
+        chunk = chunk_times(nsvt, pt.sleep_onset, pt.lights_on, dt_chunk)
+
+        # build a control window for each  +/-10 minute interval from NSVT offset
+        ctrl_windows = get_control_windows(nsvt, chunk, config.control_window, config.interval)
+
+        # divide each window into control periods
+        for poss_ctl_periods in pt.get_control_periods_batch(ctrl_windows, config.control_period):
+            if poss_ctl_periods:
+                # select one of the possible control periods
+                selected = rng.sample(poss_ctl_periods, 1)
+                ctrl_periods.append(selected)
+
+        # skip this NSVT event if there are not sufficient number of control periods
+        if len(ctrl_periods) < config.min_n_ctrl_periods:
+            continue
+
+        # downselect number of control periods
+        if config.n_ctrl_periods is not None:
+            if len(ctrl_periods) >= config.n_ctrl_periods:
+                ctrl_periods = rng.sample(ctrl_periods, config.n_ctrl_periods)
+            else:
+                continue
+
+        # determine the hazard period for the NSVT
+        hazard_period = pt.get_hazard_period(nsvt, config.control_period, config.hazard_offset)
+
+        selected_events.append((nsvt, chunk, [hazard_period] + [ctrl[0] for ctrl in ctrl_periods]))
+
+    # compute the features of every period of every stratum in one go
+    periods = [period for nsvt, chunk, event_periods in selected_events for period in event_periods]
+    if not periods:
+        return []
+    features = compute_period_features(pt, periods)
+
+    # prepare output, the hazard period comes first in each stratum followed by the control periods
+    strata = []
+    k = 0
+    for n_nsvt, (nsvt, chunk, event_periods) in enumerate(selected_events, 1):
+        # the columns describing the NSVT and its chunk are the same for every row of the stratum
+        nsvt_stage = pt.get_sleep_stage(nsvt)
+        nsvt_columns = (pt.to_walltime(nsvt).strftime('%H:%M:%S'),     # NSVT_start
+                        "",                                             # duration of NSVT, sec
+                        nsvt_stage,                                     # NSVT_sstage
+                        int(round_us(chunk[1] - chunk[0])) / 60.0,     # segment_duration
+                        pt.to_walltime(chunk[0]).strftime('%H:%M:%S'),  # segment_start
+                        pt.to_walltime(chunk[1]).strftime('%H:%M:%S'))  # segment_end
+
+        outline = []
+        for i, period in enumerate(event_periods):
+            # the HP comes first, it takes the sleep stage at the start of the NSVT rather than of the period
+            is_hazard = i == 0
+            outline.append(period_row(pt, features, k, n_nsvt, period, is_hazard,
+                                      nsvt_stage if is_hazard else features['sleep_stage'][k]) + nsvt_columns)
+            k += 1
+        strata.append(outline)
+
+    return strata
+
+def period_row(pt, features, k, n_nsvt, period, is_hazard, sleep_stage):
+    """The columns of row k of the output of compute_period_features up to minsat, for the n_nsvt'th NSVT"""
+    min_sat = features['minsat'][k]
+
+    # there are sometimes data dropout which will cause the min saturation == inf but R does not like that
+    # simply write an empty string instead
+    if min_sat == float('inf'):
+        min_sat = ""
+
+    return (pt.id,      # pt ID
+            n_nsvt,     # NSVT number for this patient
+            "?",        # segment event number
+            1 if is_hazard else 0,      # 1 for the HP, 0 for the control periods
+            features['epoch_number'][k],    # epoch # of start of period
+            pt.to_walltime(period[0]).strftime('%H:%M:%S'),     # start of period
+            sleep_stage,
+            features['PLMS_event'][k],      # PLMS_event
+            features['PLMS_type'][k, 0],    # PLMS_type1
+            features['PLMS_type'][k, 1],    # PLMS_type2
+            features['PLMS_type'][k, 2],    # PLMS_type3
+            features['PLMS_type'][k, 3],    # PLMS_type4
+            features['PLMS_type'][k, 4],    # PLMS_type5
+            features['resp_event'][k],      # any resp events
+            features['resp_type'][k, 0],    # resp_type1
+            features['resp_type'][k, 1],    # resp_type2
+            features['arousal'][k],         # number of arousals during period
+            features['PLMS_assos'][k],      # number of arousals associated to PLM during period
+            features['resp_assos'][k],      # resp_assos - number of resp associated arousals
+            min_sat)                        # min saturation
+
+def load_patient(task, files=None):
+    with instrument.patient(task.pt_id):
+        return Patient(task.pt_id, task.study_times, task.start_time, task.nsvt_times, task.xml_path, task.cache,
+                       files)
+
+def patient_results(task, pt):
+    """Build the strata of a loaded patient for each Config.
+    Each configuration gets a fresh RNG from the patient's seed, so its control periods are the same as if it had
+    been run on its own."""
+    with instrument.patient(task.pt_id):
+        return pt.id, [patient_strata(pt, config, random.Random(task.seed)) for config in task.configs]
+
+def process_patient(task):
+    """Load a patient and build its strata for each Config.  This is the unit of work given to each worker process.
+    The patient is only loaded once however many configurations there are."""
+    return patient_results(task, load_patient(task))
+
+def iter_patients(tasks, read_ahead=0, prefetcher=None):
+    """Load the patient of each task in turn, yielding (task, Patient).
+    Nothing is kept once the caller moves on to the next patient, so memory does not grow with the number of tasks.
+    If read_ahead > 0 the patients are loaded on a background thread, with up to read_ahead of them waiting, so that
+    reading the files of the next patients overlaps with processing the current one.  If a prefetch.Prefetcher is
+    given the raw files are read further ahead, several at a time, and the patients are parsed from memory."""
+    if prefetcher is not None:
+        inputs = prefetcher.prefetch(tasks)
+    else:
+        inputs = ((task, None) for task in tasks)
+
+    if read_ahead <= 0:
+        for task, files in inputs:
+            yield task, load_patient(task, files)
+        return
+
+    loaded = Queue.Queue(maxsize=read_ahead)
+    stop = threading.Event()
+
+    def put(item):
+        # give up if the consumer has gone away, rather than blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def loader():
+        try:
+            for task, files in inputs:
+                if not put((task, load_patient(task, files), None)):
+                    return
+        except Exception:
+            put((None, None, sys.exc_info()))
+            return
+        put((None, None, None))
+
+    thread = threading.Thread(target=loader)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            task, pt, exc_info = loaded.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if task is None:
+                return
+            yield task, pt
+    finally:
+        stop.set()
+
+def bounded_imap(pool, func, tasks, max_in_flight):
+    """Like pool.imap, but no more than max_in_flight tasks are submitted ahead of the result being consumed.
+    pool.imap hands every task to the pool at once and keeps the results that come back early (behind a slow patient)
+    until they are consumed; here memory is bounded by max_in_flight results whatever the size of the cohort."""
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+def try_process_patient(task):
+    """process_patient, but return the error instead of raising it so the other patients can carry on.
+    Returns (pt_id, config_strata, None) or (pt_id, None, the formatted traceback)"""
+    try:
+        pt_id, config_strata = process_patient(task)
+        return pt_id, config_strata, None
+    except Exception:
+        return task.pt_id, None, traceback.format_exc()
+
+def worker_count(n_workers):
+    # None means every core
+    return multiprocessing.cpu_count() if n_workers is None else n_workers
+
+def make_pool(n_workers):
+    """A pool of n_workers processes (all cores if None), or None to run in this process if n_workers is 1"""
+    n_workers = worker_count(n_workers)
+    return multiprocessing.Pool(n_workers) if n_workers > 1 else None
+
+@timed('pipeline.write_strata')
+def write_strata(writers, stratum, config_strata):
+    """Number and write the strata of one patient, stratum is the last number used in each output and is updated.
+    Returns the range [first, last] of the numbers given in each output, None where the patient has no strata"""
+    ranges = []
+    for i, strata in enumerate(config_strata):
+        first = stratum[i] + 1
+        for outline in strata:
+            stratum[i] += 1
+            writers[i].write_rows([(stratum[i],) + row for row in outline])
+            count('rows', len(outline))
+        ranges.append([first, stratum[i]] if strata else None)
+    return ranges
+
+def run(tasks, writers, n_workers=None, read_ahead=0, prefetcher=None):
+    """Process every patient and write their rows, one output for each Config of the tasks.
+    Patients are handed out to n_workers processes (all cores if None, in-process if 1).  Results are merged back in
+    the order of tasks so the stratum numbering is global and identical however many workers are used.
+    Patients are streamed: each one is loaded, processed, written and released in turn, with only a bounded number
+    in flight, so memory use does not depend on the size of the cohort.
+
+    :param tasks: iterable of Task
+    :param writers: list of writer.ResultsWriter the rows are written to, one per Config in task.configs
+    :param n_workers: number of worker processes
+    :param read_ahead: when running in-process, the number of patients loaded ahead on a background thread
+    :param prefetcher: when running in-process, optional prefetch.Prefetcher to read the input files ahead.  With a
+                       pool each worker reads its own files, so the reads of different patients already overlap
+    :return: list of the number of strata written to each output
+    """
+    pool = make_pool(n_workers)
+    if pool is None:
+        results = (patient_results(task, pt) for task, pt in iter_patients(tasks, read_ahead, prefetcher))
+    else:
+        results = bounded_imap(pool, process_patient, tasks, IN_FLIGHT_PER_WORKER * worker_count(n_workers))
+
+    # the stratum numbering of each output is independent
+    stratum = [0] * len(writers)
+    try:
+        for pt_id, config_strata in results:
+            print pt_id
+            write_strata(writers, stratum, config_strata)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return stratum
+
+def update_checkpoint(tasks, checkpoint, n_workers=None):
+    """The resumable version of the processing done by run: the strata of each patient are kept in checkpoint as soon
+    as it is done, and assemble writes the outputs from them once every patient is done.
+    Patients that are already in the checkpoint with the same inputs are not processed again, so after a crash (or a
+    change to a few input files) only the missing patients are redone.  A patient that fails does not stop the
+    others, it is recorded as failed in the checkpoint (and tried again next time).
+
+    :param tasks: list of Task
+    :param checkpoint: checkpoint.Checkpoint
+    :param n_workers: number of worker processes
+    :return: list of the ids of the patients that failed
+    """
+    finished = checkpoint.finished(tasks)
+    todo = [task for task in tasks if task.pt_id not in finished]
+    print "%d of %d patients already done" % (len(tasks) - len(todo), len(tasks))
+
+    by_id = dict((task.pt_id, task) for task in todo)
+    failed = []
+    pool = make_pool(n_workers)
+    if pool is None:
+        results = itertools.imap(try_process_patient, todo)
+    else:
+        results = pool.imap_unordered(try_process_patient, todo)
+    try:
+        for pt_id, config_strata, error in results:
+            if error is not None:
+                print "%s failed:\n%s" % (pt_id, error)
+                checkpoint.save_failure(by_id[pt_id], error)
+                failed.append(pt_id)
+                continue
+            print pt_id
+            checkpoint.save(by_id[pt_id], config_strata)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if failed:
+        print "%d patients failed, fix them and run again to resume: %s" % (len(failed), ", ".join(failed))
+    return failed
+
+def assemble(tasks, writers, checkpoint):
+    """Write the rows of every patient in checkpoint, numbering the strata in the order of tasks as run does.
+    Patients that failed (or were never processed) are left out and reported.  The range of strata given to each
+    patient is recorded in the manifest.
+
+    :param tasks: list of Task, as given to update_checkpoint
+    :param writers: list of writer.ResultsWriter the rows are written to, one per Config in task.configs
+    :param checkpoint: checkpoint.Checkpoint
+    :return: list of the number of strata written to each output
+    """
+    entries = checkpoint.entries()
+    finished = checkpoint.finished(tasks)
+    stratum = [0] * len(writers)
+    manifest = []
+    missing = []
+    for task in tasks:
+        if task.pt_id not in finished:
+            missing.append(task.pt_id)
+            if task.pt_id in entries:
+                manifest.append(entries[task.pt_id])    # keep the record of the failure
+            continue
+        entry = entries[task.pt_id]
+        entry['strata'] = write_strata(writers, stratum, checkpoint.load(task.pt_id))
+        manifest.append(entry)
+    checkpoint.write_manifest(manifest)
+
+    if missing:
+        print "%d patients left out of the results as they failed or have not been processed: %s" % (
+            len(missing), ", ".join(missing))
+    return stratum
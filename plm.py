@@ -1,31 +1,125 @@
 ###########################################################
 # plm.py
 # Define class Plm which is a single Periodic Limb Movement
-# event defined by a side, start time, and end time
+# event defined by a side, start time, and end time, the
+# structured array that holds a batch of them, and the
+# vectorized passes over that: merge_bilateral which joins
+# left and right movements that start together, and
+# find_plm_series which groups movements into periodic series
 #
 # Ryan D May
 # Cairn Systems
 # January 3rd, 2016
 ###########################################################
 
+import numpy as np
+
+from association import expand_ranges
+
+BILATERAL_WITHIN = 0.5      # seconds between the starts of a left and a right movement scored as a single PLM
+
+SERIES_MIN_COUNT = 4        # movements in a periodic series
+SERIES_MIN_INTERVAL = 5.0   # seconds between the starts of consecutive movements of a series
+SERIES_MAX_INTERVAL = 90.0
+
+# a batch of movements is a structured array of PLM_DTYPE, one record per movement.  The side is a small integer
+# code, see PLM_SIDES
+PLM_DTYPE = np.dtype([('tstart', np.float64), ('tend', np.float64), ('side', np.int8)])
+PLM_SIDES = {None: 0, 'Left': 1, 'Right': 2}
+
+
+class Plm(object):
+    __slots__ = ('tstart', 'tend', 'side')
 
-class Plm:
     def __init__(self, tstart=None, tend=None, side=None):
         self.tstart = tstart
         self.tend = tend
         self.side = side
 
-    # returns the duration of the event
+    # returns the duration of the event, tstart and tend are in seconds
     def duration(self):
-        return (self.tend - self.tstart).seconds
+        return self.tend - self.tstart
 
     # determines if an event SELF is associated with another
     # PLM event PREV_EVENT
-    def is_associated(self, prev_event, dt_start=0.5):
+    def is_associated(self, prev_event, dt_start=BILATERAL_WITHIN):
         if self.side == prev_event.side:
             return False
 
-        if (self.tstart - prev_event.tstart).seconds < dt_start:
+        dt = round(self.tstart - prev_event.tstart, 6)
+        if dt >= 0 and dt < dt_start:
             return True
         else:
             return False
+
+
+def plm_array(tstarts, tends, sides):
+    """Build a structured array of PLM_DTYPE from sequences of start times, end times and side codes"""
+    plms = np.empty(len(tstarts), dtype=PLM_DTYPE)
+    plms['tstart'] = tstarts
+    plms['tend'] = tends
+    plms['side'] = sides
+    return plms
+
+def merge_bilateral(plms, within=BILATERAL_WITHIN):
+    """Join the movements of the two legs that are scored as a single PLM.
+    Taking the movements in order, each one joins the group of the movement before it if it is on the other side to
+    that movement and starts no earlier than the first movement of the group and less than within seconds after it
+    (see Plm.is_associated).  A group ends at the latest end of its movements.  Isolated pairs, by far the most
+    common case, are settled with array operations, and runs of three or more candidates with one forward scan over
+    just those movements, so the cost is O(n) either way.
+
+    :param plms: structured array of PLM_DTYPE
+    :return: two arrays, the start and end times of the groups
+    """
+    tstart = plms['tstart']
+    n = tstart.size
+    if n == 0:
+        return np.empty(0), np.empty(0)
+
+    # link[k] joins movement k to the group of movement k - 1.  Within a group every start is at least that of the
+    # first movement, so a movement less than within after the one before it is a candidate
+    dt = np.round(np.diff(tstart), 6)
+    link = np.zeros(n, dtype=bool)
+    link[1:] = (plms['side'][1:] != plms['side'][:-1]) & (dt < within)
+
+    # a candidate on its own joins a group that starts with the movement before it
+    chained = link & (np.concatenate((link[1:], [False])) | np.concatenate(([False], link[:-1])))
+    link[1:] &= chained[1:] | (dt >= 0)
+
+    # in a run of candidates the first movement of the group depends on which links before it held
+    starts = tstart.tolist()
+    links = link.tolist()
+    first = 0
+    for k in np.flatnonzero(chained).tolist():
+        if not links[k - 1]:
+            first = k - 1
+        gap = round(starts[k] - starts[first], 6)
+        if gap < 0 or gap >= within:
+            links[k] = False
+    link = np.array(links, dtype=bool)
+
+    heads = np.flatnonzero(~link)
+    return tstart[heads], np.maximum.reduceat(plms['tend'], heads)
+
+
+def find_plm_series(starts, min_count=SERIES_MIN_COUNT, min_interval=SERIES_MIN_INTERVAL,
+                    max_interval=SERIES_MAX_INTERVAL):
+    """Group movements into periodic series: runs of at least min_count consecutive movements whose starts are
+    between min_interval and max_interval seconds (inclusive) apart.  One pass over the intervals, O(n).
+
+    :param starts: sorted array of the start times of the movements, in seconds
+    :return: int32 array with the series number (0, 1, ... in time order) of each movement, -1 if it is in none
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    series = np.full(starts.size, -1, dtype=np.int32)
+    interval = np.round(np.diff(starts), 6)
+    linked = (interval >= min_interval) & (interval <= max_interval)  # linked[i] joins movements i and i + 1
+
+    # run-length encode the links.  The run of links lo .. hi - 1 joins movements lo .. hi
+    edges = np.diff(np.concatenate(([False], linked, [False])).astype(np.int8))
+    lo, hi = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) + 1
+    keep = hi - lo >= min_count
+    i, j = expand_ranges(lo[keep], hi[keep])
+    series[j] = i
+    return series
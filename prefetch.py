@@ -0,0 +1,83 @@
+###########################################################
+# prefetch.py
+# Define class Prefetcher, which reads the XML and EDF files
+# of the next patients on a pool of threads while the
+# current patient is being processed, to hide the latency
+# of a slow (network) drive
+###########################################################
+
+import collections
+import os
+from multiprocessing.pool import ThreadPool
+
+from patient import input_files
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class Prefetcher(object):
+    """Read the input files of upcoming patients ahead of time.
+    The files of up to depth patients are read concurrently on n_threads threads, in task order, while the caller
+    works on the current patient.  No more than max_bytes of file content are held at once (a single patient bigger
+    than that is still read, on its own).  Patients whose arrays are already in the cache are not read at all.
+    Args:
+        depth: number of patients to read ahead, including the one being processed
+        max_bytes: upper bound on the bytes of file content held in memory
+        n_threads: number of files read at the same time
+    """
+    def __init__(self, depth=4, max_bytes=1024**3, n_threads=4):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.n_threads = n_threads
+
+    def paths_to_read(self, task):
+        paths = input_files(task.pt_id, task.xml_path)
+        if task.cache is not None:
+            try:
+                if task.cache.contains(task.cache.key(paths)):
+                    return []
+            except OSError:
+                pass    # a file is missing, let the patient find out when it is loaded
+        return paths
+
+    def prefetch(self, tasks):
+        """Yield (task, files) for each task in order, where files is a dictionary of the bytes of its input files
+        keyed by path, to be given to Patient.  A file that could not be read is left out, so that the patient reads
+        it again and reports the error itself."""
+        pool = ThreadPool(self.n_threads)
+        pending = collections.deque()   # (task, {path: AsyncResult}, n_bytes) in task order
+        held = 0
+        try:
+            for task in tasks:
+                paths = self.paths_to_read(task)
+                try:
+                    n_bytes = sum(os.path.getsize(path) for path in paths)
+                except OSError:
+                    paths, n_bytes = [], 0
+
+                # wait for the caller to be done with earlier patients until there is room for this one
+                while pending and (len(pending) >= self.depth or held + n_bytes > self.max_bytes):
+                    item = pending.popleft()
+                    yield self.collect(item)
+                    held -= item[2]
+
+                pending.append((task, dict((path, pool.apply_async(read_file, (path,))) for path in paths), n_bytes))
+                held += n_bytes
+
+            while pending:
+                yield self.collect(pending.popleft())
+        finally:
+            pool.terminate()
+
+    def collect(self, item):
+        task, reads, n_bytes = item
+        files = {}
+        for path, result in reads.iteritems():
+            try:
+                files[path] = result.get()
+            except (IOError, OSError):
+                pass
+        return task, files
@@ -0,0 +1,251 @@
+###########################################################
+# signals.py
+# Define class Signal which holds one uniformly sampled EDF
+# channel as a NumPy array, and class RangeMin which answers
+# minimum-over-a-window queries on it in constant time
+###########################################################
+
+import datetime
+import math
+import numpy as np
+
+from association import expand_ranges
+
+MAX_GATHER = 1 << 22    # samples gathered at once when computing percentiles
+
+
+class Signal(object):
+    """A single channel sampled at a fixed rate.
+    Sample i was taken at origin + i / sample_rate.  Windows are turned into sample indices arithmetically, there is
+    no per-sample timestamp.
+    Args:
+        origin: datetime of the first sample
+        values: 1-d NumPy array of samples
+        sample_rate: frequency (Hz) of the samples
+    """
+    __slots__ = ('origin', 'values', 'sample_rate')
+
+    def __init__(self, origin, values, sample_rate):
+        self.origin = origin
+        self.values = np.asarray(values, dtype=np.float64)
+        self.sample_rate = float(sample_rate)
+
+    def __len__(self):
+        return self.values.size
+
+    def to_seconds(self, when):
+        if isinstance(when, datetime.datetime):
+            return (when - self.origin).total_seconds()
+        return float(when)
+
+    def index_bounds(self, period):
+        """Indices [i0, i1) of the samples taken at or after period[0] and strictly before period[1]"""
+        # sample times are only resolved to the microsecond (as they would be as datetimes) so allow half of one
+        # before rounding up to the next sample
+        i0 = int(math.ceil((self.to_seconds(period[0]) - 0.5e-6) * self.sample_rate))
+        i1 = int(math.ceil((self.to_seconds(period[1]) - 0.5e-6) * self.sample_rate))
+        n = self.values.size
+        return min(max(i0, 0), n), min(max(i1, 0), n)
+
+    def index_bounds_batch(self, periods):
+        """index_bounds of each row of an array of shape (n, 2) of seconds since origin, as two arrays (i0, i1)"""
+        periods = np.asarray(periods, dtype=np.float64).reshape(-1, 2)
+        bounds = np.ceil((periods - 0.5e-6) * self.sample_rate)
+        bounds = np.clip(bounds, 0, self.values.size).astype(np.intp)
+        return bounds[:, 0], bounds[:, 1]
+
+    def window_stats(self, periods, stats, valid=None):
+        """Reduce the samples of each period to each of a list of statistics.
+        The statistics are 'min', 'max', 'mean', 'count' (number of samples) and 'pNN' for the NNth percentile, e.g.
+        'p50' for the median.  Each can be prefixed 'masked_' (e.g. 'masked_min') to only use the samples where valid
+        is True, i.e. to leave out artifacts.  min, max and mean are answered from a range-min table and prefix sums, so
+        the cost is one pass over the channel plus a constant per period; percentiles gather and sort the samples of
+        each period.
+
+        :param periods: array of shape (n, 2) of seconds since origin
+        :param stats: list of statistic names
+        :param valid: optional boolean array, one per sample, for the masked_ statistics
+        :return: array of shape (n, len(stats)), NaN where a period has no (valid) samples
+        """
+        i0, i1 = self.index_bounds_batch(periods)
+        result = np.full((i0.size, len(stats)), np.nan)
+
+        for masked in (False, True):
+            use = valid if masked and valid is not None else None
+            columns = [(k, stat[len('masked_'):] if masked else stat) for k, stat in enumerate(stats)
+                       if stat.startswith('masked_') == masked]
+            if not columns:
+                continue
+
+            values = self.values if use is None else np.where(use, self.values, 0.0)
+            ok = np.ones(self.values.size, dtype=bool) if use is None else use
+            counts = prefix_sum(ok)
+            n = counts[i1] - counts[i0]
+            percentiles = []
+            for k, stat in columns:
+                if stat == 'count':
+                    result[:, k] = n
+                elif stat == 'mean':
+                    sums = prefix_sum(values)
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        result[:, k] = (sums[i1] - sums[i0]) / n
+                elif stat == 'min':
+                    result[:, k] = RangeMin(self.values, use).min_batch(i0, i1)
+                elif stat == 'max':
+                    result[:, k] = -RangeMin(-self.values, use).min_batch(i0, i1)
+                elif stat.startswith('p'):
+                    percentiles.append((k, float(stat[1:])))
+                else:
+                    raise ValueError("Unknown statistic %s" % stat)
+
+            if percentiles:
+                result[:, [k for k, q in percentiles]] = self.window_percentiles(i0, i1, [q for k, q in percentiles],
+                                                                                  ok)
+
+        # no samples gives +/-inf for min and max
+        result[np.isinf(result)] = np.nan
+        return result
+
+    def window_percentiles(self, i0, i1, q, ok):
+        """Percentiles q of values[i0[p]:i1[p]] (samples where ok is True) for each p, shape (len(i0), len(q))"""
+        result = np.full((i0.size, len(q)), np.nan)
+        widths = np.maximum(i1 - i0, 0)
+        ends = np.cumsum(widths)
+
+        # as many periods at a time as have MAX_GATHER samples between them, or a single longer period
+        start = 0
+        while start < i0.size:
+            stop = int(np.searchsorted(ends, ends[start] - widths[start] + MAX_GATHER, side='right'))
+            stop = max(stop, start + 1)
+            result[start:stop] = self.gather_percentiles(i0[start:stop], i1[start:stop], q, ok)
+            start = stop
+        return result
+
+    def gather_percentiles(self, i0, i1, q, ok):
+        """The work of window_percentiles for one batch of periods.
+        Only the samples of each period are gathered (no padding to the longest period), then each percentile is
+        interpolated between the two nearest ranks of its period the same way as np.percentile."""
+        result = np.full((i0.size, len(q)), np.nan)
+        p, idx = expand_ranges(i0, i1)
+        values = self.values[idx]
+        keep = ok[idx] & ~np.isnan(values)
+        p, values = p[keep], values[keep]
+
+        n = np.bincount(p, minlength=i0.size)
+        has = n > 0
+        first = (np.cumsum(n) - n)[has]
+        last = n[has] - 1
+
+        # the two ranks each percentile is interpolated between, then only those ranks of each period are put in
+        # place by partitioning its samples where they lie (the samples are grouped by period)
+        rank = np.true_divide(q, 100.0)[None, :] * last[:, None]
+        below = np.floor(rank).astype(np.intp)
+        above = np.minimum(below + 1, last[:, None])
+        weight = rank - below
+        groups = np.split(values, np.cumsum(n)[:-1])
+        for group, kth in zip([g for g in groups if g.size], np.hstack((below, above)).tolist()):
+            group.partition(kth)
+
+        result[has] = values[first[:, None] + below] * (1.0 - weight) + values[first[:, None] + above] * weight
+        return result
+
+
+def prefix_sum(values):
+    # sums[i] is the sum of values[:i]
+    return np.concatenate(([0], np.cumsum(values, dtype=np.float64)))
+
+def valid_range(values, bounds):
+    """Boolean mask of the values strictly between bounds (lo, hi), either of which may be None"""
+    lo, hi = bounds
+    valid = np.ones(values.shape, dtype=bool)
+    if lo is not None:
+        valid &= values > lo
+    if hi is not None:
+        valid &= values < hi
+    return valid
+
+
+class RangeMin(object):
+    """Range minimum queries over a fixed array.
+    The array is cut into blocks and a sparse table is built over the block minima, so a query looks at no more than
+    two partial blocks plus two table entries.  Memory is the array plus O((n / block) log(n / block)).
+    Args:
+        values: 1-d NumPy array
+        valid: optional boolean array, samples where it is False are ignored (treated as +inf)
+        block: number of samples per block
+    """
+    def __init__(self, values, valid=None, block=32):
+        values = np.asarray(values, dtype=np.float64)
+        if valid is not None:
+            values = np.where(valid, values, np.inf)
+        self.values = values
+        self.block = block
+
+        n_blocks = -(-values.size // block)
+        padded = np.full(n_blocks * block, np.inf)
+        padded[:values.size] = values
+        level = padded.reshape(n_blocks, block).min(axis=1) if n_blocks else padded
+
+        # table[k][b] is the minimum of blocks b .. b + 2**k - 1
+        self.table = [level]
+        width = 1
+        while 2 * width <= n_blocks:
+            level = np.minimum(level[:-width], level[width:])
+            self.table.append(level)
+            width *= 2
+
+    def _blocks_min(self, b0, b1):
+        # minimum of the whole blocks b0 .. b1 - 1
+        k = int(b1 - b0).bit_length() - 1
+        level = self.table[k]
+        return min(level[b0], level[b1 - (1 << k)])
+
+    def min(self, i0, i1):
+        """Minimum of values[i0:i1], +inf if the range is empty or holds no valid samples"""
+        if i1 <= i0:
+            return np.inf
+        b0 = -(-i0 // self.block)   # first whole block
+        b1 = i1 // self.block       # one past the last whole block
+        if b1 <= b0:
+            return self.values[i0:i1].min()
+
+        result = self._blocks_min(b0, b1)
+        if i0 < b0 * self.block:
+            result = min(result, self.values[i0:b0 * self.block].min())
+        if i1 > b1 * self.block:
+            result = min(result, self.values[b1 * self.block:i1].min())
+        return result
+
+    def _partial_min(self, starts, stops):
+        # minimum of values[starts[q]:stops[q]] for ranges shorter than one block, gathered as rows of a 2-d array
+        idx = starts[:, None] + np.arange(self.block)
+        valid = idx < stops[:, None]
+        gathered = self.values[np.clip(idx, 0, self.values.size - 1)]
+        return np.where(valid, gathered, np.inf).min(axis=1)
+
+    def min_batch(self, i0, i1):
+        """Minimum of values[i0[q]:i1[q]] for each q, the vector form of min"""
+        i0 = np.asarray(i0, dtype=np.intp)
+        i1 = np.asarray(i1, dtype=np.intp)
+        result = np.full(i0.size, np.inf)
+        if self.values.size == 0:
+            return result
+
+        b0 = -(-i0 // self.block)
+        b1 = i1 // self.block
+
+        # the whole blocks, grouped by the level of the table that covers them
+        whole = np.flatnonzero(b1 > b0)
+        if whole.size:
+            k = np.frexp(b1[whole] - b0[whole])[1] - 1
+            for level_k in np.unique(k):
+                q = whole[k == level_k]
+                level = self.table[level_k]
+                result[q] = np.minimum(level[b0[q]], level[b1[q] - (1 << level_k)])
+
+        # the partial blocks either side of them (or the whole range, if it has no whole block)
+        head_end = np.minimum(b0 * self.block, i1)
+        tail_start = np.maximum(b1 * self.block, head_end)
+        result = np.minimum(result, self._partial_min(i0, head_end))
+        result = np.minimum(result, self._partial_min(tail_start, i1))
+        return result
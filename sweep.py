@@ -0,0 +1,51 @@
+###########################################################
+# sweep.py
+# Run the case-crossover design for every combination of the
+# parameters below.  Each patient is loaded once and all of
+# the configurations are evaluated against it.  The paths,
+# seed, workers and cache are the ones set in induction.py
+###########################################################
+
+import itertools
+import os
+
+import instrument
+
+from induction import RESULTS_DIR, OUTPUT_FILE, N_WORKERS, N_READ_AHEAD, make_tasks, make_prefetcher
+from pipeline import Config, run
+from writer import open_writer
+
+# every combination of these values is run.  Units are the same as the DT_* and N_* settings in induction.py
+SWEEP_CONTROL_WINDOW  = [2.5*60]
+SWEEP_INTERVAL        = [5*60]
+SWEEP_CONTROL_PERIOD  = [30]
+SWEEP_HAZARD_OFFSET   = [0]
+SWEEP_N_CTRL_PERIODS  = [3]
+SWEEP_MIN_N_CTRL_PERIODS = [1]
+
+def sweep_configs():
+    return [Config(*values) for values in itertools.product(SWEEP_CONTROL_WINDOW,
+                                                            SWEEP_INTERVAL,
+                                                            SWEEP_CONTROL_PERIOD,
+                                                            SWEEP_HAZARD_OFFSET,
+                                                            SWEEP_N_CTRL_PERIODS,
+                                                            SWEEP_MIN_N_CTRL_PERIODS)]
+
+def output_file(config):
+    """Name of the results file for a configuration, e.g. \\results_cw150_int300_cp30_ho0_n3_min1.csv
+    The format (extension) is the same as OUTPUT_FILE"""
+    ext = os.path.splitext(OUTPUT_FILE)[1]
+    return '\\results_cw{:g}_int{:g}_cp{:g}_ho{:g}_n{}_min{}'.format(*config) + ext
+
+if __name__ == '__main__':
+    instrument.start()
+    configs = sweep_configs()
+    tasks = make_tasks(configs)
+
+    writers = [open_writer(RESULTS_DIR + output_file(config)) for config in configs]
+    try:
+        run(tasks, writers, N_WORKERS, N_READ_AHEAD, make_prefetcher())
+    finally:
+        for writer in writers:
+            writer.close()
+    instrument.finish()
@@ -0,0 +1,74 @@
+###########################################################
+# test_association.py
+# Cross-check the sweep-line association functions against
+# the pairwise tests in helper.py on random EventTables
+###########################################################
+
+import datetime
+import unittest
+
+import numpy as np
+
+from association import associated_pairs, plm_arousal_mask
+from events import EventTable
+from helper import is_associated, plm_arousal_associated
+
+ORIGIN = datetime.datetime(2000, 1, 1, 22, 0, 0)
+CONSTRAINTS = [(None, 0.5), (-0.5, 0.5), (-3.0, 3.0), (0.5, None), (None, None)]
+
+
+def random_events(rng, n):
+    """EventTable of n events on a coarse grid, so that tied starts and gaps right on a constraint are common"""
+    starts = np.round(rng.randint(0, 60, n) * 0.25, 6)
+    ends = np.round(starts + rng.randint(0, 12, n) * 0.25, 6)
+    return EventTable(ORIGIN, starts, ends)
+
+def tuples(events):
+    return zip(events.starts.tolist(), events.ends.tolist())
+
+
+class AssociatedPairsTest(unittest.TestCase):
+    def test_matches_is_associated(self):
+        rng = np.random.RandomState(0)
+        for trial in range(200):
+            events1 = random_events(rng, rng.randint(0, 15))
+            events2 = random_events(rng, rng.randint(0, 15))
+            for constraint in CONSTRAINTS:
+                for fixedOrder in (False, True):
+                    expected = [(i, j)
+                                for i, e1 in enumerate(tuples(events1))
+                                for j, e2 in enumerate(tuples(events2))
+                                if is_associated(e1, e2, constraint, fixedOrder)]
+                    i, j = associated_pairs(events1, events2, constraint, fixedOrder)
+                    self.assertEqual(zip(i.tolist(), j.tolist()), expected,
+                                     'trial %d, constraint %s, fixedOrder %s' % (trial, constraint, fixedOrder))
+
+    def test_same_table(self):
+        # tied starts within one table, as when a table is associated with itself
+        rng = np.random.RandomState(1)
+        for trial in range(100):
+            events = random_events(rng, rng.randint(0, 20))
+            for constraint in CONSTRAINTS:
+                expected = [(i, j)
+                            for i, e1 in enumerate(tuples(events))
+                            for j, e2 in enumerate(tuples(events))
+                            if is_associated(e1, e2, constraint, True)]
+                i, j = associated_pairs(events, events, constraint, True)
+                self.assertEqual(zip(i.tolist(), j.tolist()), expected)
+
+
+class PlmArousalMaskTest(unittest.TestCase):
+    def test_matches_plm_arousal_associated(self):
+        rng = np.random.RandomState(2)
+        for trial in range(200):
+            plms = random_events(rng, rng.randint(0, 15))
+            arousals = random_events(rng, rng.randint(0, 15))
+            for constraint in [(0, 0.5), (-0.5, 0.5), (-3.0, 3.0)]:
+                expected = [any(plm_arousal_associated(plm, arousal, constraint) for plm in tuples(plms))
+                            for arousal in tuples(arousals)]
+                mask = plm_arousal_mask(plms, arousals, constraint)
+                self.assertEqual(mask.tolist(), expected, 'trial %d, constraint %s' % (trial, constraint))
+
+
+if __name__ == '__main__':
+    unittest.main()
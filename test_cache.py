@@ -0,0 +1,53 @@
+###########################################################
+# test_cache.py
+# Save, load and evict PatientCache entries in a temporary
+# directory, including entries that were cut short
+###########################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from cache import PatientCache
+
+
+class PatientCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_round_trip(self):
+        cache = PatientCache(self.cache_dir)
+        cache.save('a', {'x': np.arange(5)})
+        self.assertEqual(cache.load('a')['x'].tolist(), range(5))
+        self.assertIsNone(cache.load('b'))
+
+    def test_corrupt_entry_is_a_miss(self):
+        cache = PatientCache(self.cache_dir, max_bytes=1 << 20)
+        cache.save('a', {'x': np.arange(1000)})
+        path = cache.entry_path('a')
+        with open(path, 'rb') as f:
+            data = f.read()
+        for cut in (10, len(data) // 2, len(data) - 10):
+            with open(path, 'wb') as f:
+                f.write(data[:cut])
+            self.assertIsNone(cache.load('a'))
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(cache.total_bytes, 0)
+
+    def test_evict(self):
+        cache = PatientCache(self.cache_dir, max_bytes=20000)
+        for k in range(10):
+            cache.save(str(k), {'x': np.zeros(500)})
+            self.assertLessEqual(cache.total_bytes, cache.max_bytes)
+        self.assertEqual(cache.total_bytes, sum(size for mtime, size, name in cache.entries()))
+        self.assertTrue(cache.contains('9'))
+
+
+if __name__ == '__main__':
+    unittest.main()
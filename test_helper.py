@@ -0,0 +1,44 @@
+###########################################################
+# test_helper.py
+# Read the annotations of a small NSRR XML document with
+# parse_annotations
+###########################################################
+
+import io
+import unittest
+
+from helper import parse_annotations
+
+XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<CMPStudyConfig>
+<EpochLength>30</EpochLength>
+<ScoredEvents>
+<ScoredEvent><Name>Recording Start Time</Name><ClockTime>00.00.00 22.00.00</ClockTime></ScoredEvent>
+<ScoredEvent><Name>PLM (Right)</Name><Start>619.1</Start><Duration>2.1</Duration></ScoredEvent>
+<ScoredEvent><Name>PLM (Left)</Name><Start>619.9</Start><Duration>3.7</Duration></ScoredEvent>
+<ScoredEvent><Name>Arousal (ASDA)</Name><Start>645.1</Start><Duration>12.7</Duration></ScoredEvent>
+<ScoredEvent><Name>Lights Off</Name></ScoredEvent>
+<ScoredEvent><Name>Central Hypopnea</Name><Start>767.3</Start><Duration>39.6</Duration></ScoredEvent>
+<ScoredEvent><Name>Obstructive Apnea</Name><Start>900.0</Start><Duration>12.0</Duration></ScoredEvent>
+</ScoredEvents>
+<SleepStages>
+<SleepStage>0</SleepStage>
+<SleepStage>2</SleepStage>
+</SleepStages>
+</CMPStudyConfig>
+"""
+
+
+class ParseAnnotationsTest(unittest.TestCase):
+    def test_events(self):
+        result = parse_annotations(io.BytesIO(XML))
+        self.assertEqual(result['sleep_stages'], [0, 2])
+        self.assertEqual(result['plm']['tstart'].tolist(), [619.1, 619.9])
+        self.assertEqual(result['arousal'], [(645.1, 645.1 + 12.7)])
+        self.assertEqual(result['resp']['h'], [(767.3, 767.3 + 39.6)])
+        self.assertEqual(result['resp']['oa'], [(900.0, 912.0)])
+        self.assertEqual(result['resp']['ca'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+###########################################################
+# test_plm.py
+# Cross-check the vectorized PLM passes in plm.py against
+# the one-movement-at-a-time loops they replace
+###########################################################
+
+import unittest
+
+import numpy as np
+
+from plm import Plm, find_plm_series, merge_bilateral, plm_array
+
+
+def merge_loop(tstarts, tends, sides, within):
+    """The bilateral merge as Patient.get_plm used to do it, one Plm at a time"""
+    plm_events = []
+    for tstart, tend, side in zip(tstarts, tends, sides):
+        event = Plm(tstart, tend, side)
+        if plm_events and event.is_associated(plm_events[-1], within):
+            plm_events[-1].tend = max(event.tend, plm_events[-1].tend)
+            plm_events[-1].side = event.side
+            continue
+        plm_events.append(event)
+    return [(e.tstart, e.tend) for e in plm_events]
+
+def series_loop(starts, min_count=4, min_interval=5.0, max_interval=90.0):
+    series = [-1] * len(starts)
+    n_series = 0
+    i = 0
+    while i < len(starts):
+        j = i
+        while j + 1 < len(starts) and min_interval <= round(starts[j + 1] - starts[j], 6) <= max_interval:
+            j += 1
+        if j - i + 1 >= min_count:
+            series[i:j + 1] = [n_series] * (j - i + 1)
+            n_series += 1
+        i = j + 1
+    return series
+
+
+class MergeBilateralTest(unittest.TestCase):
+    def check(self, tstarts, tends, sides, within=0.5):
+        starts, ends = merge_bilateral(plm_array(tstarts, tends, sides), within)
+        self.assertEqual(zip(starts.tolist(), ends.tolist()),
+                         merge_loop(list(tstarts), list(tends), list(sides), within))
+
+    def test_random(self):
+        rng = np.random.RandomState(0)
+        steps = [0, 0.1, 0.2, 0.3, 0.49, 0.5, 0.9, 1.0, 3.0, -0.2, -0.6]
+        for trial in range(2000):
+            n = rng.randint(0, 30)
+            if trial % 3:
+                tstarts = np.round(100 + np.cumsum(rng.choice(steps, n)), 3)
+            else:
+                tstarts = np.round(100 + rng.rand(n) * 3, 1)    # out of order, with ties
+            tends = np.round(tstarts + rng.rand(n) * 3, 2)
+            self.check(tstarts, tends, rng.randint(0, 3, n), rng.choice([0.25, 0.5, 1.0]))
+
+    def test_alternating(self):
+        # every movement is a candidate for the group of the one before it
+        for step in (0.1, 0.2, 0.3):
+            tstarts = np.round(np.arange(500) * step, 6)
+            self.check(tstarts, tstarts + 1.0, np.arange(500) % 2 + 1)
+
+    def test_empty(self):
+        self.check([], [], [])
+
+
+class FindPlmSeriesTest(unittest.TestCase):
+    def test_random(self):
+        rng = np.random.RandomState(1)
+        for trial in range(1000):
+            n = rng.randint(0, 40)
+            starts = np.round(np.cumsum(rng.choice([1.0, 4.999, 5.0, 20.0, 90.0, 90.001, 150.0], n)), 3)
+            self.assertEqual(find_plm_series(starts).tolist(), series_loop(starts.tolist()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+###########################################################
+# test_signals.py
+# Cross-check the batched window statistics of a Signal
+# against NumPy on the samples of each period
+###########################################################
+
+import datetime
+import unittest
+
+import numpy as np
+
+from signals import Signal
+
+ORIGIN = datetime.datetime(2000, 1, 1, 22, 0, 0)
+
+
+class WindowPercentilesTest(unittest.TestCase):
+    def test_matches_percentile(self):
+        rng = np.random.RandomState(0)
+        signal = Signal(ORIGIN, np.round(rng.rand(3000) * 100, 1), 1)
+        ok = rng.rand(3000) > 0.2
+        q = [0, 10, 33.3, 50, 90, 100]
+        for trial in range(200):
+            n = rng.randint(0, 20)
+            i0 = rng.randint(0, 3000, n)
+            i1 = np.clip(i0 + rng.randint(-3, 300, n), 0, 3000)
+            if n and trial % 4 == 0:
+                i0[0], i1[0] = 0, 3000      # one period much longer than the others
+            result = signal.window_percentiles(i0, i1, q, ok)
+            for p in range(n):
+                samples = signal.values[i0[p]:i1[p]][ok[i0[p]:i1[p]]]
+                if samples.size:
+                    self.assertEqual(result[p].tolist(), np.percentile(samples, q).tolist())
+                else:
+                    self.assertTrue(np.isnan(result[p]).all())
+
+    def test_window_stats(self):
+        signal = Signal(ORIGIN, np.arange(10.0), 2)
+        valid = np.arange(10) % 2 == 0
+        result = signal.window_stats([(0, 2.5), (1, 1), (0, 5)], ['p50', 'masked_p50', 'count'], valid)
+        self.assertEqual(result[:, 0].tolist()[0::2], [2.0, 4.5])
+        self.assertEqual(result[:, 1].tolist()[0::2], [2.0, 4.0])
+        self.assertTrue(np.isnan(result[1, :2]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+###########################################################
+# writer.py
+# Writers for the results table.  Rows are collected in
+# per-column buffers and written out in large batches, as
+# CSV (the original layout, byte for byte) or as a typed
+# Parquet or Feather file
+###########################################################
+
+import os
+
+import numpy as np
+
+from instrument import timed
+
+# pyarrow is only needed for Parquet and Feather output
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# the output columns, in order, and their type in the typed formats.  In the CSV an empty string stands for a
+# missing value, in Parquet and Feather it is a null
+COLUMNS = [('stratum', 'int64'),
+           ('ID', 'string'),
+           ('patient_event_number', 'int64'),
+           ('segment_event_number', 'string'),
+           ('case_control', 'int64'),
+           ('epoch_number', 'int64'),
+           ('period_start_time', 'string'),
+           ('sleep_stage', 'int64'),
+           ('PLMS_event', 'int64'),
+           ('PLMS_type1', 'int64'),
+           ('PLMS_type2', 'int64'),
+           ('PLMS_type3', 'int64'),
+           ('PLMS_type4', 'int64'),
+           ('PLMS_type5', 'int64'),
+           ('resp_event', 'int64'),
+           ('resp_type1', 'int64'),
+           ('resp_type2', 'int64'),
+           ('arousal', 'int64'),
+           ('PLMS_assos', 'int64'),
+           ('resp_assos', 'int64'),
+           ('minsat', 'float64'),
+           ('NSVT_start', 'string'),
+           ('NSVT_duration', 'float64'),
+           ('NSVT_sstage', 'int64'),
+           ('segment_duration', 'float64'),
+           ('segment_start', 'string'),
+           ('segment_end', 'string')]
+
+HEADER = ",".join(name for name, dtype in COLUMNS) + "\n"
+ROW_FORMAT = "{}," * (len(COLUMNS) - 1) + "{}\n"
+
+BUFFER_ROWS = 50000     # rows held in memory before they are written out
+
+
+class ResultsWriter(object):
+    """Base class of the results writers.
+    Rows are tuples of values, one per entry of COLUMNS.  They are appended to one buffer per column and handed to
+    write_batch whenever BUFFER_ROWS have been collected, and when the writer is closed.  Writers are context
+    managers:
+        with open_writer(RESULTS_DIR + '\\results.csv') as writer:
+            writer.write_rows(rows)
+    Args:
+        path: file to write, it is replaced if it exists
+        buffer_rows: number of rows to collect before writing them out
+    """
+    def __init__(self, path, buffer_rows=BUFFER_ROWS):
+        self.path = path
+        self.buffer_rows = buffer_rows
+        self.columns = [[] for c in COLUMNS]
+        self.n_buffered = 0
+        self.n_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_rows(self, rows):
+        for row in rows:
+            for column, value in zip(self.columns, row):
+                column.append(value)
+            self.n_buffered += 1
+            if self.n_buffered >= self.buffer_rows:
+                self.flush()
+
+    @timed('output.flush')
+    def flush(self):
+        """Write out the buffered rows"""
+        if self.n_buffered:
+            self.write_batch(self.columns)
+            self.n_rows += self.n_buffered
+        self.columns = [[] for c in COLUMNS]
+        self.n_buffered = 0
+
+    def write_batch(self, columns):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+class CsvWriter(ResultsWriter):
+    """Write the results as CSV, exactly as the rows have always been written"""
+    def __init__(self, path, buffer_rows=BUFFER_ROWS):
+        ResultsWriter.__init__(self, path, buffer_rows)
+        self.f = open(path, 'w')
+        self.f.write(HEADER)
+
+    def write_batch(self, columns):
+        self.f.write("".join(ROW_FORMAT.format(*row) for row in zip(*columns)))
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+
+def typed_column(values, dtype):
+    """Convert one column buffer to a pyarrow array of the type given in COLUMNS, "" becomes null"""
+    if dtype == 'string':
+        return pyarrow.array([None if v == "" else str(v) for v in values], type=pyarrow.string())
+    mask = np.array([v == "" for v in values], dtype=bool)
+    data = np.array([0 if v == "" else v for v in values], dtype=dtype)
+    return pyarrow.array(data, mask=mask)
+
+
+class ArrowWriter(ResultsWriter):
+    """Base class of the writers of typed columnar files, which need pyarrow"""
+    def __init__(self, path, buffer_rows=BUFFER_ROWS):
+        if pyarrow is None:
+            raise ImportError("pyarrow is needed to write %s" % path)
+        ResultsWriter.__init__(self, path, buffer_rows)
+        self.schema = pyarrow.schema([pyarrow.field(name, pyarrow.string() if dtype == 'string' else
+                                                    pyarrow.from_numpy_dtype(np.dtype(dtype)))
+                                      for name, dtype in COLUMNS])
+        self.sink = None
+
+    def record_batch(self, columns):
+        return pyarrow.RecordBatch.from_arrays([typed_column(values, dtype)
+                                                for values, (name, dtype) in zip(columns, COLUMNS)],
+                                               [name for name, dtype in COLUMNS])
+
+    def close(self):
+        self.flush()
+        if self.sink is None:
+            # nothing was written, still leave an empty table behind
+            self.write_batch([[] for c in COLUMNS])
+        self.sink.close()
+
+
+class ParquetWriter(ArrowWriter):
+    """Write the results as a Parquet file, one row group per batch"""
+    def write_batch(self, columns):
+        if self.sink is None:
+            self.sink = pyarrow.parquet.ParquetWriter(self.path, self.schema)
+        self.sink.write_table(pyarrow.Table.from_batches([self.record_batch(columns)], self.schema))
+
+
+class FeatherWriter(ArrowWriter):
+    """Write the results as a Feather (version 2, i.e. the Arrow IPC file format) file, one record batch per batch"""
+    def write_batch(self, columns):
+        if self.sink is None:
+            self.sink = pyarrow.RecordBatchFileWriter(self.path, self.schema)
+        self.sink.write_batch(self.record_batch(columns))
+
+
+WRITERS = {'.csv': CsvWriter,
+           '.parquet': ParquetWriter,
+           '.feather': FeatherWriter}
+
+def open_writer(path, buffer_rows=BUFFER_ROWS):
+    """Open the writer for the format given by the extension of path: .csv, .parquet or .feather"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in WRITERS:
+        raise ValueError("Unknown results format %s, expected one of %s" % (ext, ", ".join(sorted(WRITERS))))
+    return WRITERS[ext](path, buffer_rows)